@@ -1,5 +1,42 @@
-from .browser import BrowserBackfill
-from .tools import ToolsBackfill
-
-tools_menu = ToolsBackfill()
-browser_menu = BrowserBackfill()
\ No newline at end of file
+from aqt import gui_hooks, mw
+from aqt.qt import QAction
+
+# Only the menu entries are set up at startup. The dialogs, the backfill engine, the log file
+# and the lookup cache are loaded the first time one of the menus is opened.
+
+def _tools():
+    from .tools import tools_backfill
+    return tools_backfill
+
+def _browser():
+    from .browser import browser_backfill
+    return browser_backfill
+
+def _add_to_tools_menu():
+    action = QAction("Backfill from Yomitan", mw)
+    action.triggered.connect(lambda: _tools().open_dialog())
+
+    action2 = QAction("Backfill from Yomitan (Preset)", mw)
+    action2.triggered.connect(lambda: _tools().open_preset_dialog())
+
+    action3 = QAction("Clear Yomitan Backfill Cache", mw)
+    action3.triggered.connect(lambda: _tools().clear_cache())
+
+    mw.form.menuTools.addAction(action)
+    mw.form.menuTools.addAction(action2)
+    mw.form.menuTools.addAction(action3)
+    mw.form.menuTools.aboutToShow.connect(lambda: _tools().warm_up())
+
+def _add_to_browser(browser):
+    action = QAction("Backfill from Yomitan", browser)
+    action.triggered.connect(lambda: _browser().open_dialog(browser))
+    browser.form.menuEdit.addAction(action)
+
+    action = QAction("Backfill from Yomitan (Preset)", browser)
+    action.triggered.connect(lambda: _browser().open_preset_dialog(browser))
+    browser.form.menuEdit.addAction(action)
+
+    browser.form.menuEdit.aboutToShow.connect(lambda: _browser().warm_up())
+
+_add_to_tools_menu()
+gui_hooks.browser_menus_did_init.append(_add_to_browser)
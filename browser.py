@@ -1,18 +1,27 @@
+from __future__ import annotations
+
 import base64
-from aqt import gui_hooks, mw
-from aqt.browser import Browser
+import os
+import time
+from typing import TYPE_CHECKING
+from aqt import mw
 from aqt.operations import CollectionOp, OpChangesWithCount
 from aqt.utils import showInfo, showWarning
 from aqt.qt import *
-from . import yomitan_api 
 
-from . import shared
+from . import metadata, selection, shared, yomitan_api
+
+if TYPE_CHECKING:
+    # only needed for annotations, the browser module is loaded by Anki when the browser opens
+    from aqt.browser import Browser
 
 class BrowserBackfill:
-    def __init__(self):
-        gui_hooks.browser_menus_did_init.append(self._add_to_browser)
+    """The browser menu entries, they are added by __init__ and forwarded here when used."""
 
-    def _open_browser_dialog(self, browser: Browser):
+    def warm_up(self):
+        shared.ping_in_background()
+
+    def open_dialog(self, browser: Browser):
         selected_note_ids = list(browser.selectedNotes())
         if not selected_note_ids:
             showWarning("No notes selected")
@@ -28,12 +37,15 @@ class BrowserBackfill:
             # qt6
             dlg.exec()
             
-    def _open_browser_dialog_preset(self, browser: Browser):
+    def open_preset_dialog(self, browser: Browser):
         selected_note_ids = list(browser.selectedNotes())
         if not selected_note_ids:
             showWarning("No notes selected")
             return
 
+        shared.when_yomitan_reachable(lambda: self._show_preset_dialog(browser, selected_note_ids))
+
+    def _show_preset_dialog(self, browser: Browser, selected_note_ids):
         dlg = self.PresetDialog(browser, selected_note_ids)
         dlg.resize(350, dlg.height())
 
@@ -44,25 +56,13 @@ class BrowserBackfill:
             # qt6
             dlg.exec()
 
-    def _add_to_browser(self, browser: Browser):
-        action = QAction("Backfill from Yomitan", browser)
-        action.triggered.connect(lambda: self._open_browser_dialog(browser))
-        browser.form.menuEdit.addAction(action)
-        
-        action = QAction("Backfill from Yomitan (Preset)", browser)
-        action.triggered.connect(lambda: self._open_browser_dialog_preset(browser))
-        browser.form.menuEdit.addAction(action)
-        
-    
     class BrowserDialog(QDialog):
         def __init__(self, parent, selected_note_ids):
             super().__init__(parent)
             self.setWindowTitle("Yomitan Backfill")
             self.note_ids = selected_note_ids
 
-            note = mw.col.get_note(self.note_ids[0])
-            card = note.cards()[0]
-            self.deck_id = card.did
+            self.deck_ids = selection.get_note_deck_ids(mw.col, self.note_ids)
 
             self.decks = QLineEdit()
             self.fields = QComboBox()
@@ -73,8 +73,11 @@ class BrowserBackfill:
             self.cancel = QPushButton("Cancel")
             self.replace = QCheckBox("Replace")
 
-            deck_name = mw.col.decks.name(self.deck_id)
-            self.decks.setText(deck_name)
+            if len(self.deck_ids) == 1:
+                self.decks.setText(mw.col.decks.name(self.deck_ids[0]))
+            else:
+                self.decks.setText(f"{len(self.deck_ids)} decks")
+                self.decks.setToolTip("\n".join(sorted(mw.col.decks.name(did) for did in self.deck_ids)))
             self.decks.setReadOnly(True)
 
             form = QFormLayout()
@@ -109,18 +112,10 @@ class BrowserBackfill:
             self.expression_field.clear()
             self.reading_field.clear()
 
-            if self.deck_id is None:
-                return
-
-            model_ids = mw.col.db.list("SELECT DISTINCT n.mid FROM notes n JOIN cards c ON n.id = c.nid WHERE c.did = ?", self.deck_id)
+            # the selected notes' own note types, regardless of which decks their cards are in
+            model_ids = selection.get_note_note_type_ids(mw.col, self.note_ids)
 
-            field_names = set()
-            for mid in model_ids:
-                model = mw.col.models.get(mid)
-                for fld in model.get('flds', []):
-                    field_names.add(fld.get('name'))
-
-            for name in sorted(field_names):
+            for name in metadata.get_field_names(model_ids):
                 self.fields.addItem(name)
                 self.expression_field.addItem(name)
                 self.reading_field.addItem(name)
@@ -134,81 +129,13 @@ class BrowserBackfill:
             handlebar = self.yomitan_handlebar.text()
             should_replace = self.replace.isChecked()
             
-            def write_media(file):
-                try:
-                    content = file.get("content")
-                    filename = file.get("ankiFilename")
-                    anki_media_dir = mw.col.media.dir()
-                    decoded = base64.b64decode(content)
-
-                    target_path = os.path.join(anki_media_dir, filename)
-
-                    with open(target_path, "wb") as f:
-                        f.write(decoded)
-                    
-                    return True
-                except Exception:
-                    return False
-
-            def get_field_from_request(fields, reading):
-                if reading:
-                    for entry in fields:
-                        if entry.get("reading") == reading:
-                            return entry.get(handlebar)
-                    return None
-                else:
-                    return fields[0].get(handlebar)
-
-            # https://github.com/wikidattica/reversoanki/pull/1/commits/62f0c9145a5ef7b2bde1dc6dfd5f23a53daac4d0
-            def backfill_notes(col):
-                notes = []
-                for nid in self.note_ids:
-                    note = col.get_note(nid)
-                    if not expression_field in note or not field in note:
-                        continue
-
-                    current = note[field].strip()
-                    if should_replace or not current:
-                        reading = note[reading_field] if reading_field else None
-                        api_request = yomitan_api.request_handlebar(note[expression_field].strip(), reading, handlebar)
-                        if not api_request:
-                            continue
-
-                        fields = api_request.get("fields")
-                        if not fields:
-                            continue
-
-                        data = get_field_from_request(fields, reading)
-                        if not data:
-                            continue
-
-                        # checks if handlebar data contains filename and writes it to anki if present
-                        dictionary_media = api_request.get("dictionaryMedia", [])
-                        for file in dictionary_media:
-                            filename = file.get("ankiFilename")
-                            if filename in data:
-                                write_media(file)
-                        
-                        audio_media = api_request.get("audioMedia", [])
-                        for file in audio_media:
-                            filename = file.get("ankiFilename")
-                            # if audio handlebar is requested, handlebar data contains the relevant audio filename, write only that file
-                            if filename in data:
-                                write_media(file)
-                                break
-
-                        note[field] = data
-                        notes.append(note)
-            
-                return OpChangesWithCount(changes=col.update_notes(notes), count=len(notes))
-            
             def on_success(result):
                 mw.col.reset()
                 showInfo(f"Updated {result.count} cards")
                 
             op = CollectionOp(
                 parent = mw,
-                op = lambda col: backfill_notes(col)
+                op = lambda col: backfill_notes(col, self.note_ids, expression_field, reading_field, field, handlebar, should_replace)
             )
             
             op.success(on_success).run_in_background()
@@ -216,10 +143,6 @@ class BrowserBackfill:
     class PresetDialog(QDialog):
         def __init__(self, parent, selected_note_ids):
             super().__init__(parent)
-            if not yomitan_api.ping_yomitan():
-                showWarning("Could not connect to the Yomitan server. Please ensure it's running.")
-                return
-
             config = mw.addonManager.getConfig(__name__)
             self.presets = config.get("presets")
 
@@ -236,6 +159,10 @@ class BrowserBackfill:
                 self.preset_selector.addItem(preset.get("name", "Unnamed Preset"), preset)
 
             self.run_button = QPushButton("Run Preset")
+            self.prefetch_button = QPushButton("Prefetch")
+            self.prefetch_button.setToolTip("Fetch from Yomitan in the background first, then apply the results in one fast run.")
+            # without the cache there is nothing to apply from
+            self.prefetch_button.setVisible(yomitan_api.backend.cacheable)
             self.cancel_button = QPushButton("Cancel")
             
             form = QFormLayout()
@@ -243,6 +170,7 @@ class BrowserBackfill:
 
             buttons = QHBoxLayout()
             buttons.addStretch()
+            buttons.addWidget(self.prefetch_button)
             buttons.addWidget(self.run_button)
             buttons.addWidget(self.cancel_button)
 
@@ -252,14 +180,16 @@ class BrowserBackfill:
             self.setLayout(layout)
             
             self.run_button.clicked.connect(self._on_run)
+            self.prefetch_button.clicked.connect(self._on_prefetch)
             self.cancel_button.clicked.connect(self.reject)
             
             self.resize(400, self.height())
             
-        def _on_run(self):
+        def _get_backfill_args(self):
+            """Returns the arguments for a backfill or prefetch run, or None if the preset is invalid."""
             preset = self.preset_selector.currentData()
             if not preset:
-                return
+                return None
 
             expression_field = preset.get("expressionField")
             reading_field = preset.get("readingField", "") # Can be None/empty
@@ -268,8 +198,97 @@ class BrowserBackfill:
 
             if not all([expression_field, targets]):
                 showWarning("The selected preset is misconfigured. It's missing 'expressionField' or 'targets'.")
+                return None
+
+            return [self.selected_note_ids], expression_field, reading_field, targets, should_replace
+
+        def _on_run(self):
+            args = self._get_backfill_args()
+            if not args:
                 return
-            
+
             self.accept() # Close dialog before starting the long operation
+
+            shared.run_backfill_operation(mw, *args)
+
+        def _on_prefetch(self):
+            args = self._get_backfill_args()
+            if not args:
+                return
+
+            self.accept()
+
+            shared.run_prefetch_operation(mw, *args)
+
+def _write_media(col, file):
+    try:
+        content = file.get("content")
+        filename = file.get("ankiFilename")
+        anki_media_dir = col.media.dir()
+        decoded = base64.b64decode(content)
+
+        target_path = os.path.join(anki_media_dir, filename)
+
+        with open(target_path, "wb") as f:
+            f.write(decoded)
+        
+        return True
+    except Exception:
+        return False
+
+def _get_field_from_request(fields, reading, handlebar):
+    if reading:
+        for entry in fields:
+            if entry.get("reading") == reading:
+                return entry.get(handlebar)
+        return None
+    else:
+        return fields[0].get(handlebar)
+
+# https://github.com/wikidattica/reversoanki/pull/1/commits/62f0c9145a5ef7b2bde1dc6dfd5f23a53daac4d0
+def backfill_notes(col, note_ids, expression_field, reading_field, field, handlebar, should_replace):
+    """The manual backfill of a single field, run by the dialog's CollectionOp. note_ids are the selected notes."""
+    notes = []
+    # notes sharing a lookup are answered from the cache, but nothing older than the run is reused
+    cached_since = time.time()
+    for nid in note_ids:
+        note = col.get_note(nid)
+        if not expression_field in note or not field in note:
+            continue
+
+        current = note[field].strip()
+        if should_replace or not current:
+            reading = note[reading_field] if reading_field else None
+            api_request = yomitan_api.request_handlebar(note[expression_field].strip(), reading, handlebar, cached_since)
+            if not api_request:
+                continue
+
+            fields = api_request.get("fields")
+            if not fields:
+                continue
+
+            data = _get_field_from_request(fields, reading, handlebar)
+            if not data:
+                continue
+
+            # checks if handlebar data contains filename and writes it to anki if present
+            dictionary_media = api_request.get("dictionaryMedia", [])
+            for file in dictionary_media:
+                filename = file.get("ankiFilename")
+                if filename in data:
+                    _write_media(col, file)
             
-            shared.run_backfill_operation(mw, self.selected_note_ids, expression_field, reading_field, targets, should_replace)
\ No newline at end of file
+            audio_media = api_request.get("audioMedia", [])
+            for file in audio_media:
+                filename = file.get("ankiFilename")
+                # if audio handlebar is requested, handlebar data contains the relevant audio filename, write only that file
+                if filename in data:
+                    _write_media(col, file)
+                    break
+
+            note[field] = data
+            notes.append(note)
+
+    return OpChangesWithCount(changes=col.update_notes(notes), count=len(notes))
+
+browser_backfill = BrowserBackfill()
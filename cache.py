@@ -0,0 +1,185 @@
+import base64
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+
+def make_key(text, max_entries, markers, version=""):
+    """
+    Builds the cache key for an /ankiFields request, independent of marker order.
+    version identifies the backend state (e.g. the Yomitan version), so updating it doesn't serve stale lookups.
+    """
+    return (version, text, max_entries, tuple(sorted(set(markers))))
+
+
+class LookupCache:
+    """
+    Thread-safe store of Yomitan /ankiFields responses.
+    Prefetching fills it from a background thread, the backfill op reads from it afterwards.
+    A response of {} marks a lookup Yomitan had no result for, so it isn't requested again
+    until its ttl runs out.
+    get can ignore lookups stored before a given time, so a run only reuses its own
+    or its prefetch's lookups and picks up changes made in Yomitan in the meantime.
+
+    Responses are kept in SQLite (in memory if no path is given) in a compact form:
+    - only the requested markers and the media referenced by them are kept,
+    - the remaining JSON is zlib-compressed,
+    - media content is stored once per content hash and referenced by its ankiFilename.
+    Once the cache grows beyond max_size bytes, the least recently used lookups are evicted.
+    """
+
+    def __init__(self, path=None, max_size=512 * 1024 * 1024):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path or ":memory:", check_same_thread=False)
+        self._db.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS lookups (
+                key TEXT PRIMARY KEY,
+                data BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                stored REAL NOT NULL,
+                last_used REAL NOT NULL,
+                expires REAL
+            );
+            CREATE INDEX IF NOT EXISTS ix_lookups_last_used ON lookups (last_used);
+            CREATE TABLE IF NOT EXISTS media (
+                hash TEXT PRIMARY KEY,
+                content BLOB NOT NULL,
+                size INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS lookup_media (
+                key TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                PRIMARY KEY (key, hash)
+            );
+            CREATE INDEX IF NOT EXISTS ix_lookup_media_hash ON lookup_media (hash);
+        """)
+        self._size = self._db.execute(
+            "SELECT (SELECT IFNULL(SUM(size), 0) FROM lookups) + (SELECT IFNULL(SUM(size), 0) FROM media)"
+        ).fetchone()[0]
+
+    def get(self, key, since=None):
+        """Returns the stored response, or None if there is none or it was stored before since."""
+        db_key = json.dumps(key, ensure_ascii=False)
+        with self._lock:
+            row = self._db.execute("SELECT data, expires, stored FROM lookups WHERE key = ?", (db_key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] is not None and row[1] < time.time():
+                self._delete_lookups([db_key])
+                self._db.commit()
+                return None
+            if since is not None and row[2] < since:
+                # left for put to replace
+                return None
+            self._db.execute("UPDATE lookups SET last_used = ? WHERE key = ?", (time.time(), db_key))
+            self._db.commit()
+
+            response = json.loads(zlib.decompress(row[0]))
+            for media_type in ("dictionaryMedia", "audioMedia"):
+                for file_info in response.get(media_type, []):
+                    content = self._db.execute("SELECT content FROM media WHERE hash = ?", (file_info.pop("hash"),)).fetchone()
+                    if content is not None:
+                        file_info["content"] = base64.b64encode(content[0]).decode("ascii")
+            return response
+
+    def put(self, key, response, ttl=None):
+        """Stores the response, it expires after ttl seconds if given."""
+        db_key = json.dumps(key, ensure_ascii=False)
+        markers = key[-1]
+        compact = {}
+        media_blobs = {}
+        if response:
+            compact["fields"] = [
+                {marker: entry[marker] for marker in markers if marker in entry}
+                for entry in response.get("fields") or []
+            ]
+            values = [value for entry in compact["fields"] for value in entry.values() if isinstance(value, str)]
+            for media_type in ("dictionaryMedia", "audioMedia"):
+                files = []
+                for file_info in response.get(media_type, []):
+                    filename = file_info.get("ankiFilename")
+                    # The backfill only ever writes media whose filename appears in a field value
+                    if not filename or not any(filename in value for value in values):
+                        continue
+                    content = base64.b64decode(file_info.get("content") or "")
+                    content_hash = hashlib.sha1(content).hexdigest()
+                    media_blobs[content_hash] = content
+                    files.append({"ankiFilename": filename, "hash": content_hash})
+                if files:
+                    compact[media_type] = files
+
+        data = zlib.compress(json.dumps(compact, ensure_ascii=False).encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            self._delete_lookups([db_key])
+            self._db.execute(
+                "INSERT INTO lookups (key, data, size, stored, last_used, expires) VALUES (?, ?, ?, ?, ?, ?)",
+                (db_key, data, len(data), now, now, now + ttl if ttl is not None else None)
+            )
+            self._size += len(data)
+            for content_hash, content in media_blobs.items():
+                inserted = self._db.execute(
+                    "INSERT OR IGNORE INTO media (hash, content, size) VALUES (?, ?, ?)",
+                    (content_hash, content, len(content))
+                ).rowcount
+                if inserted:
+                    self._size += len(content)
+                self._db.execute("INSERT OR IGNORE INTO lookup_media (key, hash) VALUES (?, ?)", (db_key, content_hash))
+            if self._size > self.max_size:
+                self._evict(keep=db_key)
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM lookups")
+            self._db.execute("DELETE FROM lookup_media")
+            self._db.execute("DELETE FROM media")
+            self._db.commit()
+            self._db.execute("VACUUM")
+            self._size = 0
+
+    def size(self):
+        """Returns the approximate number of bytes used by the cached lookups and media."""
+        with self._lock:
+            return self._size
+
+    def _evict(self, keep):
+        # Evict down to 90% of the cap, so we don't have to evict again on the next put
+        target = self.max_size * 0.9
+        while self._size > target:
+            keys = [row[0] for row in self._db.execute(
+                "SELECT key FROM lookups WHERE key != ? ORDER BY last_used LIMIT 10", (keep,)
+            )]
+            if not keys:
+                break
+            self._delete_lookups(keys)
+
+    def _delete_lookups(self, keys):
+        placeholders = ",".join("?" * len(keys))
+        self._size -= self._db.execute(
+            f"SELECT IFNULL(SUM(size), 0) FROM lookups WHERE key IN ({placeholders})", keys
+        ).fetchone()[0]
+        hashes = [row[0] for row in self._db.execute(f"SELECT hash FROM lookup_media WHERE key IN ({placeholders})", keys)]
+        self._db.execute(f"DELETE FROM lookups WHERE key IN ({placeholders})", keys)
+        self._db.execute(f"DELETE FROM lookup_media WHERE key IN ({placeholders})", keys)
+        # Media is shared between lookups, only drop blobs nothing references anymore
+        for content_hash in set(hashes):
+            if self._db.execute("SELECT 1 FROM lookup_media WHERE hash = ? LIMIT 1", (content_hash,)).fetchone():
+                continue
+            self._size -= self._db.execute("SELECT IFNULL(SUM(size), 0) FROM media WHERE hash = ?", (content_hash,)).fetchone()[0]
+            self._db.execute("DELETE FROM media WHERE hash = ?", (content_hash,))
+
+    def __contains__(self, key):
+        db_key = json.dumps(key, ensure_ascii=False)
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM lookups WHERE key = ?", (db_key,)).fetchone() is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM lookups").fetchone()[0]
@@ -0,0 +1,226 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import zipfile
+from . import yomitan_api
+
+# Markers the local backend can answer, others are left out of the response so
+# get_field_from_response returns None for them and the target is skipped.
+supported_markers = (
+    "expression",
+    "reading",
+    "frequency-harmonic-rank",
+    "frequency-average-rank",
+    "pitch-accent-positions",
+)
+
+logger = logging.getLogger(__name__)
+
+# what Yomitan renders for the rank markers if no frequency is known
+default_frequency_rank = 9999999
+
+class LocalDictionaryBackend(yomitan_api.Backend):
+    """
+    Answers text markers from exported Yomitan dictionaries, without the browser.
+    The term and term meta banks of the dictionary zips are imported into a SQLite index
+    on the first ping, and re-imported whenever a zip changes.
+    Only exact matches on the expression or its reading are found, there is no deinflection.
+    """
+    cacheable = False
+    unreachable_message = "The local dictionaries could not be loaded. Check 'localDictionaries' in the add-on config and the add-on log."
+
+    def __init__(self, index_path, dictionary_paths):
+        self.index_path = index_path
+        self.dictionary_paths = dictionary_paths
+        self._lock = threading.Lock()
+        self._db = None
+        self._frequency_dictionaries = None
+
+    def ping(self):
+        try:
+            with self._lock:
+                self._update_index()
+                titles = [row[0] for row in self._db.execute("SELECT title FROM dictionaries ORDER BY title")]
+        except (OSError, zipfile.BadZipFile, KeyError, IndexError, TypeError, ValueError, sqlite3.Error) as e:
+            # a broken zip, malformed banks or a broken index (json.JSONDecodeError is a ValueError)
+            logger.exception(f"Indexing the local dictionaries failed: {e!r}")
+            return False
+        if not titles:
+            return False
+        return {"backend": "local", "dictionaries": titles}
+
+    def request(self, text, markers, max_entries):
+        with self._lock:
+            if self._db is None:
+                self._update_index()
+            entries = self._find_entries(text, max_entries)
+            if not entries:
+                return None
+
+            fields = []
+            for expression, reading in entries:
+                entry = {}
+                for marker in markers:
+                    if marker == "expression":
+                        entry[marker] = expression
+                    elif marker == "reading":
+                        entry[marker] = reading
+                    elif marker == "frequency-harmonic-rank":
+                        ranks = self._get_frequency_ranks(expression, reading)
+                        entry[marker] = str(int(len(ranks) / sum(1 / rank for rank in ranks)) if ranks else default_frequency_rank)
+                    elif marker == "frequency-average-rank":
+                        ranks = self._get_frequency_ranks(expression, reading)
+                        entry[marker] = str(int(sum(ranks) / len(ranks)) if ranks else default_frequency_rank)
+                    elif marker == "pitch-accent-positions":
+                        entry[marker] = self._get_pitch_positions(expression, reading)
+                fields.append(entry)
+
+        return {"fields": fields, "dictionaryMedia": [], "audioMedia": []}
+
+    def _find_entries(self, text, max_entries):
+        """Returns up to max_entries (expression, reading) pairs, exact expression matches and higher scores first."""
+        rows = self._db.execute(
+            "SELECT expression, reading FROM terms WHERE expression = ? OR reading = ? "
+            "GROUP BY expression, reading ORDER BY expression = ? DESC, MAX(score) DESC LIMIT ?",
+            (text, text, text, max_entries)
+        ).fetchall()
+        if rows:
+            return rows
+
+        # Frequency or pitch dictionaries without a term dictionary still know the readings
+        rows = self._db.execute(
+            "SELECT expression, reading FROM frequencies WHERE expression = ? "
+            "UNION SELECT expression, reading FROM pitches WHERE expression = ?",
+            (text, text)
+        ).fetchall()
+        entries = [(expression, reading) for expression, reading in rows if reading]
+        if not entries and rows:
+            # only frequencies without a reading, which apply to every reading
+            entries = [(text, text)]
+        return entries[:max_entries]
+
+    def _get_frequency_ranks(self, expression, reading):
+        # One rank per dictionary, occurrence based dictionaries aren't ranks
+        ranks = []
+        for dictionary, value in self._db.execute(
+            "SELECT dictionary, MIN(value) FROM frequencies WHERE expression = ? AND (reading IS NULL OR reading = ?) "
+            "AND value > 0 GROUP BY dictionary",
+            (expression, reading)
+        ):
+            if self._frequency_dictionaries.get(dictionary) != "occurrence-based":
+                ranks.append(value)
+        return ranks
+
+    def _get_pitch_positions(self, expression, reading):
+        positions = []
+        for (row,) in self._db.execute(
+            "SELECT positions FROM pitches WHERE expression = ? AND reading = ? ORDER BY rowid",
+            (expression, reading)
+        ):
+            for position in json.loads(row):
+                if position not in positions:
+                    positions.append(position)
+
+        if len(positions) <= 1:
+            return "".join(str(position) for position in positions)
+        return "<ol>" + "".join(f"<li>{position}</li>" for position in positions) + "</ol>"
+
+    def _update_index(self):
+        """Opens the index and re-imports the dictionaries that were added, changed or removed."""
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            self._db = sqlite3.connect(self.index_path, check_same_thread=False)
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS dictionaries (
+                    path TEXT PRIMARY KEY,
+                    title TEXT NOT NULL,
+                    mtime REAL NOT NULL,
+                    frequency_mode TEXT
+                );
+                CREATE TABLE IF NOT EXISTS terms (expression TEXT NOT NULL, reading TEXT NOT NULL, score INTEGER NOT NULL, dictionary TEXT NOT NULL);
+                CREATE INDEX IF NOT EXISTS ix_terms_expression ON terms (expression);
+                CREATE INDEX IF NOT EXISTS ix_terms_reading ON terms (reading);
+                CREATE TABLE IF NOT EXISTS frequencies (expression TEXT NOT NULL, reading TEXT, value REAL NOT NULL, dictionary TEXT NOT NULL);
+                CREATE INDEX IF NOT EXISTS ix_frequencies_expression ON frequencies (expression);
+                CREATE TABLE IF NOT EXISTS pitches (expression TEXT NOT NULL, reading TEXT NOT NULL, positions TEXT NOT NULL, dictionary TEXT NOT NULL);
+                CREATE INDEX IF NOT EXISTS ix_pitches_expression ON pitches (expression);
+            """)
+
+        indexed = set()
+        for path, title, mtime in self._db.execute("SELECT path, title, mtime FROM dictionaries").fetchall():
+            if path in self.dictionary_paths and os.path.exists(path) and os.path.getmtime(path) == mtime:
+                indexed.add(path)
+            else:
+                self._remove_dictionary(path, title)
+        for path in self.dictionary_paths:
+            if not os.path.exists(path):
+                # the other dictionaries still answer, so a typo in the config would only leave fields empty
+                logger.warning(f"Local dictionary {path} does not exist, check 'localDictionaries' in the add-on config.")
+            elif path not in indexed:
+                self._import_dictionary(path)
+
+        self._frequency_dictionaries = dict(self._db.execute("SELECT title, frequency_mode FROM dictionaries"))
+
+    def _remove_dictionary(self, path, title):
+        with self._db:
+            for table in ("terms", "frequencies", "pitches"):
+                self._db.execute(f"DELETE FROM {table} WHERE dictionary = ?", (title,))
+            self._db.execute("DELETE FROM dictionaries WHERE path = ?", (path,))
+
+    def _import_dictionary(self, path):
+        with zipfile.ZipFile(path) as archive, self._db:
+            index = json.loads(archive.read("index.json"))
+            title = index["title"]
+            # a changed zip of the same dictionary may have been added under another path
+            self._db.execute("DELETE FROM dictionaries WHERE title = ?", (title,))
+            for table in ("terms", "frequencies", "pitches"):
+                self._db.execute(f"DELETE FROM {table} WHERE dictionary = ?", (title,))
+
+            for name in archive.namelist():
+                if re.fullmatch(r"term_bank_\d+\.json", name):
+                    self._db.executemany(
+                        "INSERT INTO terms (expression, reading, score, dictionary) VALUES (?, ?, ?, ?)",
+                        ((row[0], row[1] or row[0], row[4] or 0, title) for row in json.loads(archive.read(name)))
+                    )
+                elif re.fullmatch(r"term_meta_bank_\d+\.json", name):
+                    self._import_term_meta(json.loads(archive.read(name)), title)
+
+            self._db.execute(
+                "INSERT INTO dictionaries (path, title, mtime, frequency_mode) VALUES (?, ?, ?, ?)",
+                (path, title, os.path.getmtime(path), index.get("frequencyMode"))
+            )
+
+    def _import_term_meta(self, rows, title):
+        frequencies = []
+        pitches = []
+        for expression, mode, data in rows:
+            if mode == "freq":
+                reading = None
+                if isinstance(data, dict) and "frequency" in data:
+                    reading = data.get("reading")
+                    data = data["frequency"]
+                value = _parse_frequency(data)
+                if value is not None:
+                    frequencies.append((expression, reading, value, title))
+            elif mode == "pitch":
+                positions = [pitch["position"] for pitch in data.get("pitches", []) if "position" in pitch]
+                if positions:
+                    pitches.append((expression, data.get("reading") or expression, json.dumps(positions), title))
+
+        self._db.executemany("INSERT INTO frequencies (expression, reading, value, dictionary) VALUES (?, ?, ?, ?)", frequencies)
+        self._db.executemany("INSERT INTO pitches (expression, reading, positions, dictionary) VALUES (?, ?, ?, ?)", pitches)
+
+def _parse_frequency(data):
+    """Returns the numeric value of a term meta frequency, which is a number, a string or {value, displayValue}."""
+    if isinstance(data, dict):
+        data = data.get("value")
+    if isinstance(data, (int, float)):
+        return data
+    if isinstance(data, str):
+        match = re.match(r"\d+", data.strip())
+        if match:
+            return int(match.group())
+    return None
@@ -0,0 +1,85 @@
+from aqt import gui_hooks, mw
+from aqt.operations import QueryOp
+
+# deck id -> ids of the note types that have cards in the deck, built on first use
+_deck_note_types = None
+# note type id -> field names
+_note_type_fields = {}
+# bumped by invalidate, so a map read while the collection changed isn't kept
+_generation = 0
+_hooks_installed = False
+
+def get_deck_field_names(deck_id):
+    """Returns the sorted field names of all note types with cards in the deck or its subdecks."""
+    deck_note_types = get_deck_note_types(mw.col)
+    model_ids = set()
+    for did in mw.col.decks.deck_and_child_ids(deck_id):
+        model_ids.update(deck_note_types.get(did, ()))
+    return get_field_names(model_ids)
+
+def get_field_names(model_ids):
+    """Returns the sorted field names of the given note types."""
+    field_names = set()
+    for mid in model_ids:
+        if mid not in _note_type_fields:
+            model = mw.col.models.get(mid)
+            _note_type_fields[mid] = [fld.get("name") for fld in model.get("flds", [])] if model else []
+        field_names.update(_note_type_fields[mid])
+    return sorted(field_names)
+
+def get_deck_note_types(col):
+    """Returns the cached deck -> note types map, reading it with a single pass over the cards if needed."""
+    global _deck_note_types
+    _install_hooks()
+    if _deck_note_types is None:
+        _deck_note_types = _read_deck_note_types(col)
+    return _deck_note_types
+
+def _read_deck_note_types(col):
+    deck_note_types = {}
+    for did, mid in col.db.execute("SELECT DISTINCT c.did, n.mid FROM cards c JOIN notes n ON n.id = c.nid"):
+        deck_note_types.setdefault(did, set()).add(mid)
+    return deck_note_types
+
+def warm_up():
+    """Builds the deck -> note types map in the background, so the first dialog opens instantly."""
+    if _deck_note_types is not None:
+        return
+    _install_hooks()
+    generation = _generation
+
+    def on_success(deck_note_types):
+        global _deck_note_types
+        # Runs on the main thread like the hooks, an invalidate while reading means the map may already be stale
+        if generation == _generation and _deck_note_types is None:
+            _deck_note_types = deck_note_types
+
+    QueryOp(parent=mw, op=_read_deck_note_types, success=on_success).run_in_background()
+
+def invalidate(*args):
+    global _deck_note_types, _generation
+    _deck_note_types = None
+    _generation += 1
+    _note_type_fields.clear()
+
+def _install_hooks():
+    """Registers the invalidation hooks, once the map is built for the first time."""
+    global _hooks_installed
+    if _hooks_installed:
+        return
+    _hooks_installed = True
+    gui_hooks.operation_did_execute.append(_on_operation_did_execute)
+    gui_hooks.sync_did_finish.append(_on_sync_did_finish)
+    gui_hooks.profile_will_close.append(invalidate)
+
+def _on_operation_did_execute(changes, handler):
+    # Adding, removing or moving cards (e.g. Change Deck) reports card changes. Answering cards
+    # in the reviewer does too, without changing decks, so those don't rebuild the map.
+    # Plain note edits (like our own backfill) don't change which note types a deck has.
+    if changes.deck or changes.notetype or (changes.card and handler is not mw.reviewer):
+        invalidate()
+        warm_up()
+
+def _on_sync_did_finish():
+    invalidate()
+    warm_up()
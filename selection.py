@@ -0,0 +1,70 @@
+from anki.collection import Collection
+from anki.utils import ids2str
+
+batch_size = 5000
+
+def get_deck_ids(col: Collection, deck_id):
+    """Returns the ids of the deck and all of its subdecks."""
+    return col.decks.deck_and_child_ids(deck_id)
+
+def get_note_type_ids(col: Collection, field_name):
+    """Returns the ids of the note types that have a field with the given name."""
+    return [
+        model["id"] for model in col.models.all()
+        if any(fld.get("name") == field_name for fld in model.get("flds", []))
+    ]
+
+def get_filtered_deck_ids(col: Collection):
+    """Returns the ids of all filtered decks."""
+    return [deck["id"] for deck in col.decks.all() if deck.get("dyn")]
+
+def iter_note_id_batches(col: Collection, deck_ids, expression_field, size=batch_size):
+    """
+    Yields the ids of the notes that have a card in one of the decks and whose note type
+    has the expression field, in batches of at most size ids ordered by note id.
+    The query starts from the decks' cards (ix_cards_sched), so a small deck of a large
+    collection only reads its own cards, and looks the notes up by id; the + keeps SQLite
+    from walking all notes of the note type instead. Every note comes up once no matter
+    how many cards it has. Cards in filtered decks count for their original deck.
+    The ids of the decks' notes are read at once, only the batches are handed out.
+    """
+    model_ids = get_note_type_ids(col, expression_field)
+    if not deck_ids or not model_ids:
+        return
+
+    decks = ids2str(deck_ids)
+    deck_cards = f"SELECT nid FROM cards WHERE did IN {decks}"
+    filtered_deck_ids = get_filtered_deck_ids(col)
+    if filtered_deck_ids:
+        # cards in filtered decks have the filtered deck as did and their home deck as odid
+        deck_cards += f" UNION SELECT nid FROM cards WHERE did IN {ids2str(filtered_deck_ids)} AND odid IN {decks}"
+
+    note_ids = col.db.list(
+        f"SELECT id FROM notes WHERE +mid IN {ids2str(model_ids)} AND id IN ({deck_cards}) ORDER BY id"
+    )
+    for start in range(0, len(note_ids), size):
+        yield note_ids[start:start + size]
+
+class DeckNoteIds:
+    """
+    The note ids to backfill in a deck and its subdecks, as batches of ids.
+    Nothing is queried until it is iterated, and it can be iterated again, e.g. to
+    apply a prefetch, without keeping the ids around in between.
+    """
+
+    def __init__(self, col: Collection, deck_id, expression_field, size=batch_size):
+        self.col = col
+        self.deck_ids = get_deck_ids(col, deck_id)
+        self.expression_field = expression_field
+        self.size = size
+
+    def __iter__(self):
+        return iter_note_id_batches(self.col, self.deck_ids, self.expression_field, self.size)
+
+def get_note_deck_ids(col: Collection, note_ids):
+    """Returns the ids of all decks the notes have cards in."""
+    return col.db.list(f"SELECT DISTINCT did FROM cards WHERE nid IN {ids2str(note_ids)}")
+
+def get_note_note_type_ids(col: Collection, note_ids):
+    """Returns the ids of the note types of the notes."""
+    return col.db.list(f"SELECT DISTINCT mid FROM notes WHERE id IN {ids2str(note_ids)}")
@@ -1,12 +1,14 @@
 import base64
+import itertools
 import json
 import logging
 import urllib
 import os
+import time
 from anki.collection import Collection
 from aqt import mw
-from aqt.operations import CollectionOp, OpChangesWithCount
-from aqt.utils import showInfo, showWarning
+from aqt.operations import CollectionOp, OpChangesWithCount, QueryOp
+from aqt.utils import askUser, showInfo, showWarning, tooltip
 from aqt.qt import *
 from urllib.error import HTTPError, URLError
 from . import yomitan_api
@@ -16,12 +18,18 @@ logger = logging.getLogger(__name__)
 
 addon_folder = os.path.join(mw.pm.addonFolder(), "backfill-anki-yomitan")
 
-file_handler = logging.FileHandler(os.path.join(addon_folder, "addon.log"))
-file_handler.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-file_handler.setFormatter(formatter)
+def _setup_logging():
+    """Attaches the log file handler, on the first operation instead of at startup."""
+    # on the add-on's package logger, so the other modules log to the file as well
+    package_logger = logging.getLogger(__name__.rpartition(".")[0])
+    if package_logger.handlers:
+        return
+    file_handler = logging.FileHandler(os.path.join(addon_folder, "addon.log"))
+    file_handler.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    file_handler.setFormatter(formatter)
 
-logger.addHandler(file_handler)
+    package_logger.addHandler(file_handler)
 
 # --- Constants and API Communication ---
 
@@ -29,17 +37,62 @@ request_url = "http://127.0.0.1:8766"
 request_timeout = 10
 ping_timeout = 5
 
-def run_backfill_operation(parent, note_ids, expression_field, reading_field, targets, should_replace):
+config = mw.addonManager.getConfig(__name__) or {}
+yomitan_api.cache_path = os.path.join(addon_folder, "user_files", "lookup_cache.sqlite3")
+yomitan_api.cache_max_size = config.get("cacheSizeMB", 512) * 1024 * 1024
+
+backend_name = config.get("backend", "yomitan-api")
+if backend_name == "local":
+    from . import local_dictionary
+    # relative paths are looked up in the add-on's user_files/dictionaries folder
+    dictionaries_folder = os.path.join(addon_folder, "user_files", "dictionaries")
+    yomitan_api.backend = local_dictionary.LocalDictionaryBackend(
+        os.path.join(addon_folder, "user_files", "dictionary_index.sqlite3"),
+        [os.path.join(dictionaries_folder, path) for path in config.get("localDictionaries", [])]
+    )
+elif backend_name != "yomitan-api":
+    _setup_logging()
+    logger.warning(f"Unknown backend '{backend_name}' in the add-on config, using the Yomitan API.")
+
+def ping_in_background():
+    """Pings Yomitan in the background unless a recent ping succeeded, so the next dialog opens without waiting."""
+    _setup_logging()
+    if not yomitan_api.cached_ping():
+        mw.taskman.run_in_background(yomitan_api.ping_yomitan, uses_collection=False)
+
+def when_yomitan_reachable(on_reachable):
+    """
+    Calls on_reachable once the backend answers, without blocking the GUI thread on the ping.
+    A recent successful ping is reused, otherwise the ping runs in the background and
+    the backend's warning is shown if it can't be reached.
+    """
+    _setup_logging()
+    if yomitan_api.cached_ping():
+        on_reachable()
+        return
+
+    def on_done(future):
+        if future.result():
+            on_reachable()
+        else:
+            showWarning(yomitan_api.backend.unreachable_message)
+
+    mw.taskman.run_in_background(yomitan_api.ping_yomitan, on_done, uses_collection=False)
+
+def run_backfill_operation(parent, note_id_batches, expression_field, reading_field, targets, should_replace, cached_since=None):
     """
     The core operation to backfill notes. Can be called by manual or preset mode.
     - parent: The parent window for the CollectionOp (usually mw or a dialog).
-    - deck_id: The ID of the deck to process.
+    - note_id_batches: The notes to process, as an iterable of note ID lists (e.g. selection.DeckNoteIds).
+      It is only iterated inside the operation and must be iterable again for a prefetch and its apply run.
     - expression_field: The note field with the term.
     - reading_field: The note field with the reading (can be None).
     - targets: A list of dicts, e.g., [{"fieldToFill": "Field1", "handlebar": "{hb1}"}, ...].
     - should_replace: Boolean flag to overwrite existing content.
+    - cached_since: Reuse cached lookups from this time on (e.g. the start of a prefetch), by default only the run's own.
     """
-    logger.info(f"Running backfill operation for {len(note_ids)} notes.")
+    _setup_logging()
+    logger.info("Running backfill operation.")
 
     def on_success(result):
         if result.count > 0:
@@ -52,20 +105,142 @@ def run_backfill_operation(parent, note_ids, expression_field, reading_field, ta
 
     op = CollectionOp(
         parent=parent,
-        op=lambda col: _backfill_op(col, note_ids, expression_field, reading_field, targets, should_replace)
+        op=lambda col: _backfill_op(col, note_id_batches, expression_field, reading_field, targets, should_replace, cached_since)
     )
     op.success(on_success).run_in_background()
 
-def _backfill_op(col: Collection, note_ids, expression_field, reading_field, targets, should_replace):
+def run_prefetch_operation(parent, note_id_batches, expression_field, reading_field, targets, should_replace):
+    """
+    Fills the lookup cache for the given notes without holding the collection, then offers to apply them.
+    The notes are only read to collect the lookups, the slow Yomitan requests then run on
+    a background task that doesn't use the collection, so Anki stays responsive.
+    The apply run is answered from the cache, except for lookups that failed or didn't fit into it.
+    """
+    _setup_logging()
+    logger.info("Running prefetch operation.")
+    started = time.time()
+
+    def on_fetched(future):
+        fetched, failed, evicted = future.result()
+        logger.info(f"Prefetched {fetched} lookups, {failed} failed, {evicted} evicted.")
+
+        message = f"Prefetched {fetched} lookups from Yomitan."
+        if failed:
+            message += f" {failed} lookups failed, they will be requested again when applying."
+        if evicted:
+            message += (
+                f" {evicted} lookups didn't fit into the cache and will be requested again when applying,"
+                " increase 'cacheSizeMB' in the add-on config to prefetch this many."
+            )
+        if askUser(f"{message} Apply them to the notes now?", parent=parent):
+            run_backfill_operation(
+                parent, note_id_batches, expression_field, reading_field, targets, should_replace, cached_since=started
+            )
+
+    def on_collected(lookups):
+        tooltip(f"Prefetching {len(lookups)} lookups from Yomitan in the background.", parent=parent)
+        mw.taskman.run_in_background(lambda: _fetch_lookups(lookups, started), on_fetched, uses_collection=False)
+
+    op = QueryOp(
+        parent=parent,
+        op=lambda col: _collect_lookups(col, note_id_batches, expression_field, reading_field, targets, should_replace),
+        success=on_collected
+    )
+    op.run_in_background()
+
+def _collect_lookups(col: Collection, note_id_batches, expression_field, reading_field, targets, should_replace):
+    """Returns the unique (expression, reading, handlebars) lookups _backfill_op would request."""
+    lookups = set()
+    for nid in itertools.chain.from_iterable(note_id_batches):
+        note = col.get_note(nid)
+        if expression_field not in note:
+            continue
+
+        expression = note[expression_field].strip()
+        if not expression:
+            continue
+
+        reading = note[reading_field] if reading_field and reading_field in note else None
+        fields_to_fill = _get_fields_to_fill(note, targets, should_replace)
+        if not fields_to_fill:
+            continue
+
+        lookups.add((expression, reading, tuple(field["handlebar"] for field in fields_to_fill)))
+    return list(lookups)
+
+def _fetch_lookups(lookups, cached_since):
+    """
+    Requests the lookups into the cache, returns the number of fetched, failed and evicted lookups.
+    Lookups are evicted again if the prefetch is larger than the cache.
+    """
+    # A failed lookup must not lose the ones already fetched, it is simply requested again when applying
+    fetched_keys = []
+    failed = 0
+    for expression, reading, handlebars in lookups:
+        try:
+            yomitan_api.request_handlebar(expression, reading, list(handlebars), cached_since)
+            fetched_keys.append(yomitan_api.get_request_key(expression, reading, list(handlebars)))
+        except ConnectionRefusedError as e:
+            # Yomitan is gone, the remaining lookups would fail the same way
+            logger.warning(f"Prefetch stopped, Yomitan can't be reached: {e}")
+            failed = len(lookups) - len(fetched_keys)
+            break
+        except Exception as e:
+            logger.warning(f"Prefetching {expression} (Reading: {reading}) failed: {e!r}")
+            failed += 1
+
+    lookup_cache = yomitan_api.get_lookup_cache()
+    evicted = sum(1 for key in fetched_keys if key not in lookup_cache)
+    return len(fetched_keys), failed, evicted
+
+def _get_fields_to_fill(note, targets, should_replace):
+    """Returns the targets that should be filled for this note, with the handlebar brackets stripped."""
+    fields_to_fill = []
+    for target in targets:
+        field_to_fill = target["fieldToFill"]
+        handlebar = target["handlebar"]
+        should_replace_field = target.get("replaceExisting", should_replace)
+
+        logger.info(f"Processing target: {field_to_fill} with handlebar: {handlebar}")
+
+        if field_to_fill not in note:
+            continue
+
+        if not field_to_fill or not handlebar:
+            # Just Empty fields, skip this target
+            continue
+
+        # Skip if field is already filled and we shouldn't replace
+        if not should_replace_field and note[field_to_fill].strip():
+            continue
+        fields_to_fill.append({"field_to_fill": field_to_fill, "handlebar": handlebar.replace("{", "").replace("}", "")})
+    return fields_to_fill
+
+def _backfill_op(col: Collection, note_id_batches, expression_field, reading_field, targets, should_replace, cached_since=None):
     """The actual operation run by CollectionOp."""
     notes_to_update = []
     anki_media_dir = col.media.dir()
+    if cached_since is None:
+        # notes sharing a lookup are still answered from the cache within the run
+        cached_since = time.time()
+    # Run statistics, logged at the end to keep an eye on throughput and redundant work
+    start_time = time.monotonic()
+    lookups = 0
+    unique_lookups = set()
+    checked_media = set()
+    written_media = 0
 
     logger.info(f"Starting backfill operation with parameters: {locals()}")
 
     def write_media_file(file_info):
+        nonlocal written_media
         try:
             filename = file_info.get("ankiFilename")
+            # Many notes share the same media, only look at each file once per run
+            if filename in checked_media:
+                return True
+            checked_media.add(filename)
+
             target_path = os.path.join(anki_media_dir, filename)
             # Avoid re-writing existing files
             if os.path.exists(target_path):
@@ -76,6 +251,7 @@ def _backfill_op(col: Collection, note_ids, expression_field, reading_field, tar
 
             with open(target_path, "wb") as f:
                 f.write(decoded)
+            written_media += 1
             return True
         except Exception as e:
             print(f"Failed to write media file {filename}: {e}")
@@ -90,7 +266,9 @@ def _backfill_op(col: Collection, note_ids, expression_field, reading_field, tar
         else:
             return fields[0].get(handlebar)
 
-    for nid in note_ids:
+    processed_notes = 0
+    for nid in itertools.chain.from_iterable(note_id_batches):
+        processed_notes += 1
         logger.info(f"Processing note ID: {nid}")
         note = col.get_note(nid)
         note_was_modified = False
@@ -107,32 +285,18 @@ def _backfill_op(col: Collection, note_ids, expression_field, reading_field, tar
             logger.info(f"Note field '{key}': {value}")
 
         reading = note[reading_field] if reading_field and reading_field in note else None
-        
-        fields_to_fill = []
-        for target in targets:
-            field_to_fill = target["fieldToFill"]
-            handlebar = target["handlebar"]
-            should_replace_field = target.get("replaceExisting", should_replace)
-            
-            logger.info(f"Processing target: {field_to_fill} with handlebar: {handlebar}")
-
-            if field_to_fill not in note:
-                continue
-            
-            if not field_to_fill or not handlebar:
-                # Just Empty fields, skip this target
-                continue
-            
-            # Skip if field is already filled and we shouldn't replace
-            if not should_replace_field and note[field_to_fill].strip():
-                continue
-            fields_to_fill.append({"field_to_fill": field_to_fill, "handlebar": handlebar.replace("{", "").replace("}", "")})
+        fields_to_fill = _get_fields_to_fill(note, targets, should_replace)
 
         logger.info(f"Found Targets: {fields_to_fill}")
+        if not fields_to_fill:
+            continue
 
         # --- API Request and Processing ---
-        api_response = yomitan_api.request_handlebar(expression, reading, [field["handlebar"] for field in fields_to_fill])
-        logger.info(f"Requesting Yomitan data for: {expression} (Reading: {reading}, Handlebar: {handlebar})")
+        handlebars = [field["handlebar"] for field in fields_to_fill]
+        lookups += 1
+        unique_lookups.add(yomitan_api.get_request_key(expression, reading, handlebars))
+        api_response = yomitan_api.request_handlebar(expression, reading, handlebars, cached_since)
+        logger.info(f"Requesting Yomitan data for: {expression} (Reading: {reading}, Handlebars: {handlebars})")
         # logger.info(f"API Response: {api_response}")
         
         # showInfo(f"Requesting Yomitan data for: {expression} (Reading: {reading}, Handlebar: {handlebar})")
@@ -171,4 +335,13 @@ def _backfill_op(col: Collection, note_ids, expression_field, reading_field, tar
         if note_was_modified:
             notes_to_update.append(note)
 
-    return OpChangesWithCount(changes=col.update_notes(notes_to_update), count=len(notes_to_update))
\ No newline at end of file
+    changes = col.update_notes(notes_to_update)
+
+    elapsed = time.monotonic() - start_time
+    logger.info(
+        f"Backfilled {len(notes_to_update)} of {processed_notes} notes in {elapsed:.1f}s "
+        f"({processed_notes / elapsed if elapsed else 0:.0f} notes/s), {lookups} lookups for "
+        f"{len(unique_lookups)} unique requests, {written_media} media files written."
+    )
+
+    return OpChangesWithCount(changes=changes, count=len(notes_to_update))
\ No newline at end of file
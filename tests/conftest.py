@@ -0,0 +1,282 @@
+"""
+The add-on only runs inside Anki, so the aqt and anki modules it imports are replaced
+with small stubs here. The repository is registered as a package named after its folder,
+like Anki does, without running __init__ (which adds the menu entries).
+"""
+import base64
+import concurrent.futures
+import importlib
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = os.path.basename(ROOT)
+
+
+def _install_stubs():
+    def module(name, **attributes):
+        stub = types.ModuleType(name)
+        stub.__dict__.update(attributes)
+        sys.modules[name] = stub
+        return stub
+
+    class OpChangesWithCount:
+        def __init__(self, changes=None, count=0):
+            self.changes = changes
+            self.count = count
+
+    # The operations run right away on mw.col, which the tests set to a FakeCollection
+    class CollectionOp:
+        def __init__(self, parent, op):
+            self._op = op
+            self._success = None
+
+        def success(self, success):
+            self._success = success
+            return self
+
+        def run_in_background(self, **kwargs):
+            result = self._op(mw.col)
+            if self._success:
+                self._success(result)
+
+    class QueryOp:
+        def __init__(self, parent, op, success):
+            self._op = op
+            self._success = success
+
+        def run_in_background(self):
+            self._success(self._op(mw.col))
+
+    def run_in_background(task, on_done=None, uses_collection=True):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(task())
+        except Exception as e:
+            future.set_exception(e)
+        if on_done:
+            on_done(future)
+
+    def show(message, *args, **kwargs):
+        messages.append(message)
+
+    def ask(message, *args, **kwargs):
+        messages.append(message)
+        return True
+
+    mw = types.SimpleNamespace(
+        col=None,
+        reviewer=object(),
+        pm=types.SimpleNamespace(addonFolder=lambda: tempfile.gettempdir()),
+        addonManager=types.SimpleNamespace(getConfig=lambda name: {}),
+        taskman=types.SimpleNamespace(run_in_background=run_in_background),
+    )
+    gui_hooks = types.SimpleNamespace(
+        operation_did_execute=[], sync_did_finish=[], profile_will_close=[], browser_menus_did_init=[]
+    )
+    module("aqt", mw=mw, gui_hooks=gui_hooks)
+    module("aqt.operations", CollectionOp=CollectionOp, QueryOp=QueryOp, OpChangesWithCount=OpChangesWithCount)
+    module("aqt.utils", showInfo=show, showWarning=show, tooltip=show, askUser=ask)
+    # only what the dialog modules need to be imported
+    module("aqt.qt", QDialog=type("QDialog", (), {}), QAction=type("QAction", (), {}))
+    module("anki")
+    module("anki.collection", Collection=object)
+    module("anki.utils", ids2str=lambda ids: f"({','.join(str(i) for i in ids)})")
+
+
+# what showInfo, showWarning, tooltip and askUser were called with
+messages = []
+
+
+def _load_package():
+    package = types.ModuleType(PACKAGE)
+    package.__path__ = [ROOT]
+    # so pytest finds it already imported when it collects the repository as a package
+    package.__file__ = os.path.join(ROOT, "__init__.py")
+    sys.modules[PACKAGE] = package
+
+
+_install_stubs()
+_load_package()
+
+
+def load(name):
+    """Imports a module of the add-on."""
+    return importlib.import_module(f"{PACKAGE}.{name}")
+
+
+class FakeNote:
+    def __init__(self, fields):
+        self._fields = fields
+        self.tags = []
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def __getitem__(self, key):
+        return self._fields[key]
+
+    def __setitem__(self, key, value):
+        self._fields[key] = value
+
+    def items(self):
+        return self._fields.items()
+
+    def add_tag(self, tag):
+        if tag not in self.tags:
+            self.tags.append(tag)
+
+
+class FakeCollection:
+    """
+    Notes are kept as field dicts, get_note hands out a fresh note for them like Anki does.
+    Notes added with a note type and their cards are also stored in db for the selection queries.
+    - decks: deck id -> ids of the deck and its subdecks
+    - models: note type dicts with id and flds
+    """
+
+    def __init__(self, media_dir, notes=None, decks=None, filtered_decks=(), models=()):
+        self.notes = notes if notes is not None else {}
+        self.updated = []
+        self.media = types.SimpleNamespace(dir=lambda: media_dir)
+        self.db = FakeDb()
+        self.db.connection.executescript("""
+            CREATE TABLE notes (id INTEGER PRIMARY KEY, mid INTEGER NOT NULL);
+            CREATE TABLE cards (
+                id INTEGER PRIMARY KEY,
+                nid INTEGER NOT NULL,
+                did INTEGER NOT NULL,
+                queue INTEGER NOT NULL DEFAULT 0,
+                due INTEGER NOT NULL DEFAULT 0,
+                odid INTEGER NOT NULL
+            );
+            -- Anki's indexes on these columns
+            CREATE INDEX idx_notes_mid ON notes (mid);
+            CREATE INDEX ix_cards_nid ON cards (nid);
+            CREATE INDEX ix_cards_sched ON cards (did, queue, due);
+            CREATE INDEX idx_cards_odid ON cards (odid) WHERE odid != 0;
+        """)
+        decks = decks or {}
+        self.decks = types.SimpleNamespace(
+            deck_and_child_ids=lambda deck_id: decks[deck_id],
+            all=lambda: [{"id": deck_id, "dyn": deck_id in filtered_decks} for deck_id in decks],
+        )
+        models = {model["id"]: model for model in models}
+        self.models = types.SimpleNamespace(all=lambda: list(models.values()), get=models.get)
+
+    def add_note(self, mid=None, **fields):
+        nid = len(self.notes) + 1
+        self.notes[nid] = fields
+        if mid is not None:
+            self.db.connection.execute("INSERT INTO notes (id, mid) VALUES (?, ?)", (nid, mid))
+        return nid
+
+    def add_card(self, nid, did, odid=0):
+        self.db.connection.execute("INSERT INTO cards (nid, did, odid) VALUES (?, ?, ?)", (nid, did, odid))
+
+    def get_note(self, nid):
+        return FakeNote(self.notes[nid])
+
+    def update_notes(self, notes):
+        self.updated.extend(notes)
+        return None
+
+    def reset(self):
+        pass
+
+
+class FakeDb:
+    """The parts of Anki's DBProxy the add-on uses, on top of sqlite3."""
+
+    def __init__(self):
+        self.connection = sqlite3.connect(":memory:")
+
+    def list(self, sql, *args):
+        return [row[0] for row in self.connection.execute(sql, args)]
+
+    def execute(self, sql, *args):
+        return self.connection.execute(sql, args).fetchall()
+
+
+class YomitanServer:
+    """
+    Answers /ankiFields from terms: text -> list of entries (marker -> value), entries
+    can list their media under "_media" as {ankiFilename: bytes}. Unknown texts get a 500.
+    """
+
+    def __init__(self):
+        self.terms = {}
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if self.path == "/yomitanVersion":
+                    return self._reply(200, {"version": "test"})
+
+                server.requests.append(body)
+                entries = server.terms.get(body["text"])
+                if not entries:
+                    return self._reply(500, {"error": "no result"})
+
+                entries = entries[:body["maxEntries"]]
+                fields = [{marker: entry.get(marker, "") for marker in body["markers"]} for entry in entries]
+                media = [
+                    {"ankiFilename": filename, "content": base64.b64encode(content).decode("ascii")}
+                    for entry in entries for filename, content in entry.get("_media", {}).items()
+                ]
+                self._reply(200, {"fields": fields, "dictionaryMedia": [], "audioMedia": media})
+
+            def _reply(self, status, data):
+                payload = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self._thread = threading.Thread(target=self.httpd.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def yomitan_server(monkeypatch):
+    yomitan_api = load("yomitan_api")
+    server = YomitanServer()
+    monkeypatch.setattr(yomitan_api, "request_url", server.url)
+    monkeypatch.setattr(yomitan_api, "backend", yomitan_api.YomitanApiBackend())
+    # a fresh in-memory cache for every test
+    monkeypatch.setattr(yomitan_api, "cache_path", None)
+    monkeypatch.setattr(yomitan_api, "_lookup_cache", None)
+    yield server
+    server.close()
+
+
+@pytest.fixture(autouse=True)
+def clear_messages():
+    messages.clear()
+
+
+@pytest.fixture
+def media_dir(tmp_path):
+    path = tmp_path / "collection.media"
+    path.mkdir()
+    return str(path)
@@ -0,0 +1,281 @@
+import os
+import time
+import tracemalloc
+
+import pytest
+
+from conftest import FakeCollection, load, messages
+
+shared = load("shared")
+
+TARGETS = [{"fieldToFill": "Glossary", "handlebar": "{glossary}"}]
+AUDIO_TARGETS = [{"fieldToFill": "Audio", "handlebar": "{audio}"}]
+
+
+def backfill(col, note_ids, targets=TARGETS, should_replace=False, reading_field="Reading"):
+    return shared._backfill_op(col, [note_ids], "Expression", reading_field, targets, should_replace)
+
+
+def add_notes(col, count, expression="生", reading="", glossary="", audio=""):
+    return [
+        col.add_note(Expression=expression, Reading=reading, Glossary=glossary, Audio=audio)
+        for _ in range(count)
+    ]
+
+
+@pytest.fixture
+def server(yomitan_server):
+    yomitan_server.terms["生"] = [
+        {"reading": "せい", "glossary": "life", "audio": "[sound:sei.mp3]", "_media": {"sei.mp3": b"sei"}},
+        {"reading": "なま", "glossary": "raw", "audio": "[sound:nama.mp3]", "_media": {"nama.mp3": b"nama"}},
+    ]
+    return yomitan_server
+
+
+@pytest.fixture
+def col(media_dir):
+    return FakeCollection(media_dir)
+
+
+def test_reading_selects_the_matching_entry(server, col):
+    nama, = add_notes(col, 1, reading="なま")
+    sei, = add_notes(col, 1, reading="せい")
+
+    result = backfill(col, [nama, sei])
+
+    assert result.count == 2
+    assert col.notes[nama]["Glossary"] == "raw"
+    assert col.notes[sei]["Glossary"] == "life"
+
+
+def test_without_reading_the_first_entry_is_used(server, col):
+    nid, = add_notes(col, 1)
+
+    backfill(col, [nid])
+
+    assert col.notes[nid]["Glossary"] == "life"
+    assert server.requests[0]["maxEntries"] == 1
+
+
+def test_reading_without_matching_entry_is_skipped(server, col):
+    nid, = add_notes(col, 1, reading="しょう")
+
+    result = backfill(col, [nid])
+
+    assert result.count == 0
+    assert col.notes[nid]["Glossary"] == ""
+
+
+def test_missing_term_is_requested_once_per_run(server, col):
+    note_ids = add_notes(col, 3, expression="未知")
+
+    assert backfill(col, note_ids).count == 0
+    assert len(server.requests) == 1
+
+
+def test_referenced_media_is_written(server, col, media_dir):
+    nid, = add_notes(col, 1, reading="なま")
+
+    backfill(col, [nid], AUDIO_TARGETS)
+
+    assert col.notes[nid]["Audio"] == "[sound:nama.mp3]"
+    with open(os.path.join(media_dir, "nama.mp3"), "rb") as f:
+        assert f.read() == b"nama"
+    # the other entry's audio isn't in the field
+    assert not os.path.exists(os.path.join(media_dir, "sei.mp3"))
+
+
+def test_media_is_written_once(server, col, media_dir, monkeypatch):
+    writes = []
+
+    def counting_open(path, mode="r", *args, **kwargs):
+        if "w" in mode:
+            writes.append(os.path.basename(path))
+        return open(path, mode, *args, **kwargs)
+
+    monkeypatch.setattr(shared, "open", counting_open, raising=False)
+    note_ids = add_notes(col, 50, reading="なま") + add_notes(col, 50, reading="せい")
+
+    backfill(col, note_ids, AUDIO_TARGETS)
+
+    assert sorted(writes) == ["nama.mp3", "sei.mp3"]
+
+
+def test_existing_media_is_not_overwritten(server, col, media_dir, monkeypatch):
+    with open(os.path.join(media_dir, "nama.mp3"), "wb") as f:
+        f.write(b"edited")
+    writes = []
+    monkeypatch.setattr(shared, "open", lambda path, *args, **kwargs: writes.append(path), raising=False)
+    nid, = add_notes(col, 1, reading="なま")
+
+    backfill(col, [nid], AUDIO_TARGETS)
+
+    assert col.notes[nid]["Audio"] == "[sound:nama.mp3]"
+    assert writes == []
+    with open(os.path.join(media_dir, "nama.mp3"), "rb") as f:
+        assert f.read() == b"edited"
+
+
+def test_filled_fields_are_kept_without_replace(server, col):
+    filled, = add_notes(col, 1, reading="なま", glossary="my notes")
+    empty, = add_notes(col, 1, reading="なま")
+
+    result = backfill(col, [filled, empty], should_replace=False)
+
+    assert result.count == 1
+    assert col.notes[filled]["Glossary"] == "my notes"
+    assert col.notes[empty]["Glossary"] == "raw"
+
+
+def test_filled_fields_are_overwritten_with_replace(server, col):
+    nid, = add_notes(col, 1, reading="なま", glossary="my notes")
+
+    assert backfill(col, [nid], should_replace=True).count == 1
+    assert col.notes[nid]["Glossary"] == "raw"
+
+
+def test_replace_existing_of_a_target_overrides_should_replace(server, col):
+    nid, = add_notes(col, 1, reading="なま", glossary="my notes", audio="[sound:mine.mp3]")
+    targets = [
+        {"fieldToFill": "Glossary", "handlebar": "{glossary}", "replaceExisting": True},
+        {"fieldToFill": "Audio", "handlebar": "{audio}", "replaceExisting": False},
+    ]
+
+    backfill(col, [nid], targets, should_replace=False)
+    assert col.notes[nid]["Glossary"] == "raw"
+    assert col.notes[nid]["Audio"] == "[sound:mine.mp3]"
+
+    col.notes[nid]["Glossary"] = "my notes"
+    backfill(col, [nid], targets, should_replace=True)
+    assert col.notes[nid]["Glossary"] == "raw"
+    assert col.notes[nid]["Audio"] == "[sound:mine.mp3]"
+
+
+def test_unchanged_notes_are_not_updated(server, col):
+    nid, = add_notes(col, 1, reading="なま", glossary="raw")
+
+    assert backfill(col, [nid], should_replace=True).count == 0
+    assert col.updated == []
+
+
+def test_one_request_per_unique_term(server, col):
+    terms = [f"語{i}" for i in range(10)]
+    for term in terms:
+        server.terms[term] = [{"reading": "ご", "glossary": term}]
+    note_ids = [nid for term in terms for nid in add_notes(col, 10, expression=term)]
+
+    result = backfill(col, note_ids)
+
+    assert result.count == 100
+    assert sorted(request["text"] for request in server.requests) == sorted(terms)
+
+
+
+def test_next_run_picks_up_changes_in_yomitan(server, col):
+    nid, = add_notes(col, 1, reading="なま")
+    backfill(col, [nid])
+
+    server.terms["生"][1]["glossary"] = "uncooked"
+    backfill(col, [nid], should_replace=True)
+
+    assert col.notes[nid]["Glossary"] == "uncooked"
+    assert len(server.requests) == 2
+
+
+def test_applying_a_prefetch_sends_no_requests(server, col, monkeypatch):
+    monkeypatch.setattr(shared.mw, "col", col)
+    terms = [f"語{i}" for i in range(10)]
+    for term in terms:
+        server.terms[term] = [{"reading": "ご", "glossary": term}]
+    note_ids = [nid for term in terms for nid in add_notes(col, 5, expression=term)]
+    requests_made = []
+
+    def apply_without_requests(*args, **kwargs):
+        requests_made.append(len(server.requests))
+        result = apply(*args, **kwargs)
+        requests_made.append(len(server.requests))
+        return result
+
+    apply = shared._backfill_op
+    monkeypatch.setattr(shared, "_backfill_op", apply_without_requests)
+    # the operation stubs run synchronously, askUser answers yes
+    shared.run_prefetch_operation(None, [note_ids], "Expression", "Reading", TARGETS, False)
+
+    assert requests_made == [len(terms), len(terms)]
+    assert [col.notes[nid]["Glossary"] for nid in note_ids] == [term for term in terms for _ in range(5)]
+    assert messages[-2].startswith("Prefetched 10 lookups from Yomitan. Apply them")
+    assert messages[-1] == "Successfully updated 50 notes."
+
+
+def test_prefetch_reports_lookups_that_did_not_fit(server, monkeypatch):
+    yomitan_api = load("yomitan_api")
+    monkeypatch.setattr(yomitan_api, "cache_max_size", 20000)
+    for i in range(100):
+        server.terms[f"語{i}"] = [{"reading": "ご", "glossary": os.urandom(500).hex()}]
+    lookups = [(f"語{i}", None, ("glossary",)) for i in range(100)]
+
+    fetched, failed, evicted = shared._fetch_lookups(lookups, time.time())
+
+    assert (fetched, failed) == (100, 0)
+    assert evicted == 100 - len(yomitan_api.get_lookup_cache())
+    assert evicted > 0
+
+
+def test_prefetch_summary_warns_about_evicted_lookups(server, col, monkeypatch):
+    monkeypatch.setattr(shared.mw, "col", col)
+    monkeypatch.setattr(load("yomitan_api"), "cache_max_size", 20000)
+    for i in range(100):
+        server.terms[f"語{i}"] = [{"reading": "ご", "glossary": os.urandom(500).hex()}]
+    note_ids = [col.add_note(Expression=f"語{i}", Reading="", Glossary="", Audio="") for i in range(100)]
+
+    shared.run_prefetch_operation(None, [note_ids], "Expression", "Reading", TARGETS, False)
+
+    summary = next(message for message in messages if message.startswith("Prefetched"))
+    assert "didn't fit into the cache" in summary
+    # the evicted lookups were requested again by the apply
+    assert 100 < len(server.requests) < 200
+    assert all(col.notes[nid]["Glossary"] for nid in note_ids)
+
+
+def test_throughput(server, col):
+    terms = [f"語{i}" for i in range(50)]
+    for term in terms:
+        server.terms[term] = [{"reading": "ご", "glossary": term}]
+    note_ids = [col.add_note(Expression=terms[i % len(terms)], Reading="", Glossary="", Audio="") for i in range(5000)]
+
+    start = time.perf_counter()
+    result = backfill(col, note_ids)
+    elapsed = time.perf_counter() - start
+
+    assert result.count == 5000
+    assert len(server.requests) == len(terms)
+    # conservative, a development machine does several times that
+    assert 5000 / elapsed > 1000
+
+
+def test_memory_is_bounded_for_large_decks(server, media_dir):
+    # notes that are already up to date, so nothing has to be held for update_notes
+    count = 50000
+    terms = [f"語{i}" for i in range(100)]
+    for term in terms:
+        server.terms[term] = [{"reading": "ご", "glossary": term}]
+    col = FakeCollection(media_dir, {
+        nid: {"Expression": terms[nid % len(terms)], "Reading": "", "Glossary": terms[nid % len(terms)], "Audio": ""}
+        for nid in range(1, count + 1)
+    })
+
+    def note_id_batches(size=5000):
+        for start in range(1, count + 1, size):
+            yield list(range(start, min(start + size, count + 1)))
+
+    tracemalloc.start()
+    try:
+        result = shared._backfill_op(col, note_id_batches(), "Expression", "Reading", TARGETS, True)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert result.count == 0
+    assert len(server.requests) == len(terms)
+    # one batch of ids and the per term state, not per note state
+    assert peak < 2 * 1024 * 1024
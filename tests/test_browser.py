@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+from conftest import FakeCollection, load
+
+browser = load("browser")
+
+
+@pytest.fixture
+def server(yomitan_server):
+    yomitan_server.terms["生"] = [
+        {"reading": "せい", "glossary": "life", "audio": "[sound:sei.mp3]", "_media": {"sei.mp3": b"sei"}},
+        {"reading": "なま", "glossary": "raw", "audio": "[sound:nama.mp3]", "_media": {"nama.mp3": b"nama"}},
+    ]
+    return yomitan_server
+
+
+@pytest.fixture
+def col(media_dir):
+    return FakeCollection(media_dir)
+
+
+def add_note(col, reading="", glossary="", audio=""):
+    return col.add_note(Expression="生", Reading=reading, Glossary=glossary, Audio=audio)
+
+
+def backfill(col, note_ids, field="Glossary", handlebar="glossary", should_replace=False):
+    return browser.backfill_notes(col, note_ids, "Expression", "Reading", field, handlebar, should_replace)
+
+
+def test_fills_only_the_selected_notes(server, col):
+    nama = add_note(col, reading="なま")
+    sei = add_note(col, reading="せい")
+    unselected = add_note(col, reading="なま")
+
+    assert backfill(col, [nama, sei]).count == 2
+
+    assert col.notes[nama]["Glossary"] == "raw"
+    assert col.notes[sei]["Glossary"] == "life"
+    assert col.notes[unselected]["Glossary"] == ""
+    assert len(server.requests) == 1
+
+
+def test_replace(server, col):
+    nid = add_note(col, reading="なま", glossary="my notes")
+
+    assert backfill(col, [nid]).count == 0
+    assert col.notes[nid]["Glossary"] == "my notes"
+
+    assert backfill(col, [nid], should_replace=True).count == 1
+    assert col.notes[nid]["Glossary"] == "raw"
+
+
+def test_writes_the_referenced_audio(server, col, media_dir):
+    nid = add_note(col, reading="せい")
+
+    backfill(col, [nid], field="Audio", handlebar="audio")
+
+    assert col.notes[nid]["Audio"] == "[sound:sei.mp3]"
+    with open(os.path.join(media_dir, "sei.mp3"), "rb") as f:
+        assert f.read() == b"sei"
+    assert not os.path.exists(os.path.join(media_dir, "nama.mp3"))
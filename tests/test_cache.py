@@ -0,0 +1,83 @@
+import base64
+import os
+
+from conftest import load
+
+cache = load("cache")
+
+
+def response(*entries, media=None):
+    return {
+        "fields": list(entries),
+        "dictionaryMedia": [],
+        "audioMedia": [
+            {"ankiFilename": filename, "content": base64.b64encode(content).decode("ascii")}
+            for filename, content in (media or {}).items()
+        ],
+    }
+
+
+def test_key_ignores_marker_order():
+    assert cache.make_key("生", 4, ["reading", "glossary"]) == cache.make_key("生", 4, ["glossary", "reading", "reading"])
+    assert cache.make_key("生", 4, ["glossary"], "1") != cache.make_key("生", 4, ["glossary"], "2")
+
+
+def test_only_requested_markers_and_referenced_media_are_kept():
+    lookup_cache = cache.LookupCache()
+    key = cache.make_key("生", 4, ["audio", "reading"])
+    lookup_cache.put(key, response(
+        {"reading": "なま", "audio": "[sound:nama.mp3]", "glossary": "raw"},
+        media={"nama.mp3": b"nama", "sei.mp3": b"sei"},
+    ))
+
+    cached = lookup_cache.get(key)
+    expected = response({"reading": "なま", "audio": "[sound:nama.mp3]"}, media={"nama.mp3": b"nama"})
+    assert cached["fields"] == expected["fields"]
+    assert cached["audioMedia"] == expected["audioMedia"]
+    assert not cached.get("dictionaryMedia")
+
+
+def test_shared_media_is_stored_once():
+    lookup_cache = cache.LookupCache()
+    media = {"hashi.mp3": b"x" * 10000}
+    lookup_cache.put(cache.make_key("橋", 1, ["audio"]), response({"audio": "[sound:hashi.mp3]"}, media=media))
+    size = lookup_cache.size()
+    lookup_cache.put(cache.make_key("箸", 1, ["audio"]), response({"audio": "[sound:hashi.mp3]"}, media=media))
+
+    assert lookup_cache.size() - size < 1000
+
+
+def test_negative_entries_expire(monkeypatch):
+    lookup_cache = cache.LookupCache()
+    key = cache.make_key("未知", 1, ["glossary"])
+    lookup_cache.put(key, {}, ttl=60)
+    assert lookup_cache.get(key) == {}
+
+    now = cache.time.time()
+    monkeypatch.setattr(cache.time, "time", lambda: now + 61)
+    assert lookup_cache.get(key) is None
+    assert key not in lookup_cache
+
+
+def test_lookups_stored_before_since_are_ignored():
+    lookup_cache = cache.LookupCache()
+    key = cache.make_key("生", 1, ["glossary"])
+    lookup_cache.put(key, response({"glossary": "raw"}))
+    stored = cache.time.time()
+
+    assert lookup_cache.get(key, since=stored - 60) is not None
+    assert lookup_cache.get(key, since=stored + 60) is None
+    assert key in lookup_cache
+
+
+def test_least_recently_used_lookups_are_evicted():
+    lookup_cache = cache.LookupCache(max_size=20000)
+    keys = [cache.make_key(f"語{i}", 1, ["glossary"]) for i in range(200)]
+    for key in keys:
+        # random content doesn't compress
+        lookup_cache.put(key, response({"glossary": base64.b64encode(os.urandom(500)).decode("ascii")}))
+
+    assert lookup_cache.size() <= 20000
+    assert keys[-1] in lookup_cache
+    assert keys[0] not in lookup_cache
+    assert 0 < len(lookup_cache) < len(keys)
@@ -0,0 +1,79 @@
+import json
+import zipfile
+
+from conftest import load
+
+local_dictionary = load("local_dictionary")
+
+
+def write_dictionary(path, index, **banks):
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("index.json", json.dumps(index))
+        for name, rows in banks.items():
+            archive.writestr(f"{name}.json", json.dumps(rows, ensure_ascii=False))
+    return str(path)
+
+
+def make_backend(tmp_path):
+    terms = write_dictionary(tmp_path / "terms.zip", {"title": "Terms"}, term_bank_1=[
+        ["生", "せい", "", "", 10, ["life"], 1, ""],
+        ["生", "なま", "", "", 5, ["raw"], 2, ""],
+    ])
+    frequencies = write_dictionary(tmp_path / "freq.zip", {"title": "Freq"}, term_meta_bank_1=[
+        ["生", "freq", {"reading": "なま", "frequency": {"value": 1000, "displayValue": "1000㋕"}}],
+        ["生", "freq", {"reading": "なま", "frequency": 4000}],
+    ])
+    pitches = write_dictionary(tmp_path / "pitch.zip", {"title": "Pitch"}, term_meta_bank_1=[
+        ["生", "pitch", {"reading": "なま", "pitches": [{"position": 1}, {"position": 0}]}],
+    ])
+    return local_dictionary.LocalDictionaryBackend(str(tmp_path / "index.sqlite3"), [terms, frequencies, pitches])
+
+
+def test_ping_lists_the_dictionaries(tmp_path):
+    assert make_backend(tmp_path).ping() == {"backend": "local", "dictionaries": ["Freq", "Pitch", "Terms"]}
+
+
+def test_ping_fails_without_dictionaries_or_on_broken_ones(tmp_path):
+    assert local_dictionary.LocalDictionaryBackend(str(tmp_path / "empty.sqlite3"), []).ping() is False
+
+    broken = tmp_path / "broken.zip"
+    broken.write_bytes(b"not a zip")
+    assert local_dictionary.LocalDictionaryBackend(str(tmp_path / "broken.sqlite3"), [str(broken)]).ping() is False
+
+    no_index = write_dictionary(tmp_path / "no_index.zip", {})
+    assert local_dictionary.LocalDictionaryBackend(str(tmp_path / "no_index.sqlite3"), [no_index]).ping() is False
+
+
+def test_request_answers_the_supported_markers(tmp_path):
+    backend = make_backend(tmp_path)
+    markers = ["reading", "frequency-harmonic-rank", "frequency-average-rank", "pitch-accent-positions", "glossary"]
+
+    response = backend.request("生", markers, 4)
+
+    assert response["fields"] == [
+        {
+            "reading": "せい",
+            "frequency-harmonic-rank": "9999999",
+            "frequency-average-rank": "9999999",
+            "pitch-accent-positions": "",
+        },
+        {
+            "reading": "なま",
+            "frequency-harmonic-rank": "1000",
+            "frequency-average-rank": "1000",
+            "pitch-accent-positions": "<ol><li>1</li><li>0</li></ol>",
+        },
+    ]
+    assert backend.request("未知", markers, 4) is None
+    assert len(backend.request("生", markers, 1)["fields"]) == 1
+
+
+def test_missing_dictionaries_are_logged(tmp_path, caplog):
+    terms = write_dictionary(tmp_path / "terms.zip", {"title": "Terms"}, term_bank_1=[["生", "せい", "", "", 10, ["life"], 1, ""]])
+    missing = str(tmp_path / "freqency.zip")
+    backend = local_dictionary.LocalDictionaryBackend(str(tmp_path / "index.sqlite3"), [terms, missing])
+
+    with caplog.at_level("WARNING"):
+        assert backend.ping() == {"backend": "local", "dictionaries": ["Terms"]}
+
+    assert missing in caplog.text
@@ -0,0 +1,69 @@
+import types
+
+import pytest
+
+from conftest import FakeCollection, load
+
+metadata = load("metadata")
+mw = metadata.mw
+
+MODELS = [
+    {"id": 1, "flds": [{"name": "Expression"}, {"name": "Reading"}]},
+    {"id": 2, "flds": [{"name": "Sentence"}]},
+]
+
+
+def card_changes(**kwargs):
+    changes = {"deck": False, "notetype": False, "note": False, "card": True}
+    changes.update(kwargs)
+    return types.SimpleNamespace(**changes)
+
+
+@pytest.fixture
+def col(monkeypatch):
+    col = FakeCollection(None, decks={10: [10], 20: [20]}, models=MODELS)
+    monkeypatch.setattr(mw, "col", col)
+    metadata.invalidate()
+    yield col
+    metadata.invalidate()
+
+
+def test_moving_cards_to_another_deck_updates_its_fields(col):
+    nid = col.add_note(1)
+    col.add_card(nid, 10)
+    assert metadata.get_deck_field_names(20) == []
+
+    # Browse -> Change Deck only reports card changes
+    col.db.connection.execute("UPDATE cards SET did = 20")
+    metadata._on_operation_did_execute(card_changes(), handler=object())
+
+    assert metadata.get_deck_field_names(20) == ["Expression", "Reading"]
+    assert metadata.get_deck_field_names(10) == []
+
+
+def test_reviews_keep_the_map(col):
+    col.add_card(col.add_note(1), 10)
+    deck_note_types = metadata.get_deck_note_types(col)
+
+    metadata._on_operation_did_execute(card_changes(), handler=mw.reviewer)
+    metadata._on_operation_did_execute(card_changes(card=False, note=True), handler=object())
+
+    assert metadata.get_deck_note_types(col) is deck_note_types
+
+
+def test_warm_up_drops_a_map_invalidated_while_reading(col, monkeypatch):
+    col.add_card(col.add_note(1), 10)
+    execute = col.db.execute
+
+    def execute_and_change(sql, *args):
+        rows = execute(sql, *args)
+        # the collection changes while the background read is running
+        col.add_card(col.add_note(2), 20)
+        metadata.invalidate()
+        return rows
+
+    monkeypatch.setattr(col.db, "execute", execute_and_change)
+    metadata.warm_up()
+    monkeypatch.setattr(col.db, "execute", execute)
+
+    assert metadata.get_deck_field_names(20) == ["Sentence"]
@@ -0,0 +1,70 @@
+from conftest import FakeCollection, load
+
+selection = load("selection")
+
+VOCAB = 1
+SENTENCE = 2
+MODELS = [
+    {"id": VOCAB, "flds": [{"name": "Expression"}, {"name": "Reading"}]},
+    {"id": SENTENCE, "flds": [{"name": "Sentence"}]},
+]
+# deck 10 with subdeck 11, deck 20, filtered deck 30
+DECKS = {10: [10, 11], 11: [11], 20: [20], 30: [30]}
+
+
+def make_collection(cards):
+    """cards: (note type id, deck id, original deck id) per note"""
+    col = FakeCollection(None, decks=DECKS, filtered_decks={30}, models=MODELS)
+    for mid, did, odid in cards:
+        col.add_card(col.add_note(mid), did, odid)
+    return col
+
+
+def test_deck_note_ids_cover_subdecks_and_filtered_cards():
+    col = make_collection([
+        (VOCAB, 10, 0),
+        (VOCAB, 11, 0),
+        (VOCAB, 20, 0),
+        (VOCAB, 30, 11),  # in a filtered deck, home is the subdeck
+        (VOCAB, 30, 20),
+        (SENTENCE, 10, 0),  # no Expression field
+    ])
+    col.add_card(1, 10)  # second card of the same note
+
+    assert list(selection.DeckNoteIds(col, 10, "Expression")) == [[1, 2, 4]]
+    assert list(selection.DeckNoteIds(col, 20, "Expression")) == [[3, 5]]
+    assert list(selection.DeckNoteIds(col, 10, "Sentence")) == [[6]]
+    assert list(selection.DeckNoteIds(col, 10, "Missing")) == []
+
+
+def test_deck_note_ids_are_batched_and_can_be_iterated_again():
+    col = make_collection([(VOCAB, 10, 0)] * 11)
+    note_ids = selection.DeckNoteIds(col, 10, "Expression", size=5)
+
+    assert list(note_ids) == [[1, 2, 3, 4, 5], [6, 7, 8, 9, 10], [11]]
+    assert list(note_ids) == list(note_ids)
+
+
+def test_deck_note_ids_start_from_the_deck_cards(monkeypatch):
+    col = make_collection([(VOCAB, did, 0) for did in (10, 11, 20) for _ in range(100)])
+    queries = []
+    list_ids = col.db.list
+    monkeypatch.setattr(col.db, "list", lambda sql, *args: queries.append(sql) or list_ids(sql, *args))
+    list(selection.DeckNoteIds(col, 11, "Expression"))
+
+    for analyze in (False, True):
+        if analyze:
+            col.db.connection.execute("ANALYZE")
+        plan = " ".join(row[3] for row in col.db.connection.execute(f"EXPLAIN QUERY PLAN {queries[0]}"))
+        assert "ix_cards_sched" in plan
+        # neither all cards by note id nor all notes of the note type
+        assert "ix_cards_nid" not in plan
+        assert "idx_notes_mid" not in plan
+
+
+def test_note_decks_and_note_types():
+    col = make_collection([(VOCAB, 10, 0), (SENTENCE, 20, 0)])
+    col.add_card(1, 11)
+
+    assert sorted(selection.get_note_deck_ids(col, [1])) == [10, 11]
+    assert sorted(selection.get_note_note_type_ids(col, [1, 2])) == [VOCAB, SENTENCE]
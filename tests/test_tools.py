@@ -0,0 +1,82 @@
+import os
+
+import pytest
+
+from conftest import FakeCollection, load
+
+tools = load("tools")
+selection = load("selection")
+
+VOCAB = 1
+MODELS = [{"id": VOCAB, "flds": [{"name": "Expression"}, {"name": "Reading"}, {"name": "Glossary"}, {"name": "Audio"}]}]
+# deck 10 with subdeck 11, deck 20
+DECKS = {10: [10, 11], 11: [11], 20: [20]}
+
+
+@pytest.fixture
+def server(yomitan_server):
+    yomitan_server.terms["生"] = [
+        {"reading": "せい", "glossary": "life", "audio": "[sound:sei.mp3]", "_media": {"sei.mp3": b"sei"}},
+        {"reading": "なま", "glossary": "raw", "audio": "[sound:nama.mp3]", "_media": {"nama.mp3": b"nama"}},
+    ]
+    return yomitan_server
+
+
+@pytest.fixture
+def col(media_dir):
+    return FakeCollection(media_dir, decks=DECKS, models=MODELS)
+
+
+def add_note(col, did, reading="", glossary="", audio="", expression="生"):
+    nid = col.add_note(VOCAB, Expression=expression, Reading=reading, Glossary=glossary, Audio=audio)
+    col.add_card(nid, did)
+    return nid
+
+
+def backfill(col, deck_id, field="Glossary", handlebar="glossary", should_replace=False, size=2):
+    note_id_batches = selection.DeckNoteIds(col, deck_id, "Expression", size=size)
+    return tools.backfill_notes(col, note_id_batches, "Expression", "Reading", field, handlebar, should_replace)
+
+
+def test_fills_the_deck_and_its_subdecks_in_batches(server, col):
+    nama = [add_note(col, 10, reading="なま") for _ in range(3)]
+    sei = add_note(col, 11, reading="せい")
+    other = add_note(col, 20, reading="なま")
+
+    result = backfill(col, 10)
+
+    assert result.count == 4
+    assert [col.notes[nid]["Glossary"] for nid in nama + [sei]] == ["raw", "raw", "raw", "life"]
+    assert col.notes[other]["Glossary"] == ""
+
+
+def test_requests_each_lookup_once(server, col):
+    for _ in range(5):
+        add_note(col, 10, reading="なま")
+        add_note(col, 10, reading="せい")
+
+    backfill(col, 10)
+
+    # both readings share the same request
+    assert len(server.requests) == 1
+
+
+def test_replace(server, col):
+    nid = add_note(col, 10, reading="なま", glossary="my notes")
+
+    assert backfill(col, 10).count == 0
+    assert col.notes[nid]["Glossary"] == "my notes"
+
+    assert backfill(col, 10, should_replace=True).count == 1
+    assert col.notes[nid]["Glossary"] == "raw"
+
+
+def test_writes_the_referenced_audio(server, col, media_dir):
+    nid = add_note(col, 10, reading="なま")
+
+    backfill(col, 10, field="Audio", handlebar="audio")
+
+    assert col.notes[nid]["Audio"] == "[sound:nama.mp3]"
+    with open(os.path.join(media_dir, "nama.mp3"), "rb") as f:
+        assert f.read() == b"nama"
+    assert not os.path.exists(os.path.join(media_dir, "sei.mp3"))
@@ -1,28 +1,27 @@
 import base64
+import itertools
+import os
+import time
 from aqt import mw
 from aqt.operations import CollectionOp, OpChangesWithCount
 from aqt.utils import showInfo, showWarning
 from aqt.qt import *
 from . import yomitan_api  
 
-from . import shared
+from . import metadata, selection, shared
 
 class ToolsBackfill:
-    def __init__(self):
-        action = QAction("Backfill from Yomitan", mw)
-        action.triggered.connect(self.open_dialog)
-        
-        action2 = QAction("Backfill from Yomitan (Preset)", mw)
-        action2.triggered.connect(self.open_preset_dialog)
-        
-        mw.form.menuTools.addAction(action)
-        mw.form.menuTools.addAction(action2)
+    """The Tools menu entries, they are added by __init__ and forwarded here when used."""
+
+    def warm_up(self):
+        # Runs when the Tools menu opens, so opening a dialog doesn't wait for the ping or the deck scan
+        shared.ping_in_background()
+        metadata.warm_up()
 
     def open_dialog(self):
-        if not yomitan_api.ping_yomitan():
-            showWarning("Unable to reach Yomitan API")
-            return
-        
+        shared.when_yomitan_reachable(self._show_dialog)
+
+    def _show_dialog(self):
         dlg = self.ToolsDialog(mw)
         dlg.resize(350, dlg.height())
 
@@ -34,10 +33,9 @@ class ToolsBackfill:
             dlg.exec()
             
     def open_preset_dialog(self):
-        if not yomitan_api.ping_yomitan():
-            showWarning("Could not connect to the Yomitan server. Please ensure it's running.")
-            return
-        
+        shared.when_yomitan_reachable(self._show_preset_dialog)
+
+    def _show_preset_dialog(self):
         config = mw.addonManager.getConfig(__name__)
         presets = config.get("presets")
         
@@ -48,6 +46,9 @@ class ToolsBackfill:
         dlg = self.PresetDialog(mw, presets)
         dlg.exec()
 
+    def clear_cache(self):
+        yomitan_api.get_lookup_cache().clear()
+        showInfo("Cleared the cached Yomitan lookups.")
 
     class ToolsDialog(QDialog):
         def __init__(self, parent):
@@ -109,15 +110,7 @@ class ToolsBackfill:
             if deck_id is None:
                 return
 
-            model_ids = mw.col.db.list("SELECT DISTINCT n.mid FROM notes n JOIN cards c ON n.id = c.nid WHERE c.did = ?", deck_id)
-
-            field_names = set()
-            for mid in model_ids:
-                model = mw.col.models.get(mid)
-                for fld in model.get('flds', []):
-                    field_names.add(fld.get('name'))
-
-            for name in sorted(field_names):
+            for name in metadata.get_deck_field_names(deck_id):
                 self.fields.addItem(name)
                 self.expression_field.addItem(name)
                 self.reading_field.addItem(name)
@@ -132,75 +125,7 @@ class ToolsBackfill:
             handlebar = self.yomitan_handlebar.text()
             should_replace = self.replace.isChecked()
             
-            note_ids = mw.col.db.list("SELECT DISTINCT nid FROM cards WHERE did = ?", deck_id)
-            
-            def write_media(file):
-                try:
-                    content = file.get("content")
-                    filename = file.get("ankiFilename")
-                    anki_media_dir = mw.col.media.dir()
-                    decoded = base64.b64decode(content)
-
-                    target_path = os.path.join(anki_media_dir, filename)
-
-                    with open(target_path, "wb") as f:
-                        f.write(decoded)
-                    
-                    return True
-                except Exception:
-                    return False
-
-            def get_field_from_request(fields, reading):
-                if reading:
-                    for entry in fields:
-                        if entry.get("reading") == reading:
-                            return entry.get(handlebar)
-                    return None
-                else:
-                    return fields[0].get(handlebar)
-
-            # https://github.com/wikidattica/reversoanki/pull/1/commits/62f0c9145a5ef7b2bde1dc6dfd5f23a53daac4d0
-            def backfill_notes(col):
-                notes = []
-                for nid in note_ids:
-                    note = col.get_note(nid)
-                    if not expression_field in note or not field in note:
-                        continue
-
-                    current = note[field].strip()
-                    if should_replace or not current:
-                        reading = note[reading_field] if reading_field else None
-                        api_request = yomitan_api.request_handlebar(note[expression_field].strip(), reading, handlebar)
-                        if not api_request:
-                            continue
-
-                        fields = api_request.get("fields")
-                        if not fields:
-                            continue
-
-                        data = get_field_from_request(fields, reading)
-                        if not data:
-                            continue
-
-                        # checks if handlebar data contains filename and writes it to anki if present
-                        dictionary_media = api_request.get("dictionaryMedia", [])
-                        for file in dictionary_media:
-                            filename = file.get("ankiFilename")
-                            if filename in data:
-                                write_media(file)
-                        
-                        audio_media = api_request.get("audioMedia", [])
-                        for file in audio_media:
-                            filename = file.get("ankiFilename")
-                            # if audio handlebar is requested, handlebar data contains the relevant audio filename, write only that file
-                            if filename in data:
-                                write_media(file)
-                                break
-
-                        note[field] = data
-                        notes.append(note)
-            
-                return OpChangesWithCount(changes=col.update_notes(notes), count=len(notes))
+            note_id_batches = selection.DeckNoteIds(mw.col, deck_id, expression_field)
             
             def on_success(result):
                 mw.col.reset()
@@ -208,7 +133,7 @@ class ToolsBackfill:
                 
             op = CollectionOp(
                 parent = mw,
-                op = lambda col: backfill_notes(col)
+                op = lambda col: backfill_notes(col, note_id_batches, expression_field, reading_field, field, handlebar, should_replace)
             )
             
             op.success(on_success).run_in_background()
@@ -234,10 +159,15 @@ class ToolsBackfill:
             form.addRow("Deck Name:", self.decks)
 
             self.run_button = QPushButton("Run Preset")
+            self.prefetch_button = QPushButton("Prefetch")
+            self.prefetch_button.setToolTip("Fetch from Yomitan in the background first, then apply the results in one fast run.")
+            # without the cache there is nothing to apply from
+            self.prefetch_button.setVisible(yomitan_api.backend.cacheable)
             self.cancel_button = QPushButton("Cancel")
 
             buttons = QHBoxLayout()
             buttons.addStretch()
+            buttons.addWidget(self.prefetch_button)
             buttons.addWidget(self.run_button)
             buttons.addWidget(self.cancel_button)
 
@@ -248,6 +178,7 @@ class ToolsBackfill:
             self._load_decks()
             
             self.run_button.clicked.connect(self._on_run)
+            self.prefetch_button.clicked.connect(self._on_prefetch)
             self.cancel_button.clicked.connect(self.reject)
             
             self.resize(400, self.height())
@@ -261,15 +192,16 @@ class ToolsBackfill:
                 self.decks.addItem(name, deck_id)
 
             
-        def _on_run(self):
+        def _get_backfill_args(self):
+            """Returns the arguments for a backfill or prefetch run, or None if the selection is invalid."""
             preset = self.preset_selector.currentData()
             deck = self.decks.currentData()
             if not preset:
-                return
+                return None
 
             if not deck:
                 showWarning(f"Deck '{deck}' from the preset could not be found.")
-                return
+                return None
 
             expression_field = preset.get("expressionField")
             reading_field = preset.get("readingField") # Can be None/empty
@@ -278,10 +210,99 @@ class ToolsBackfill:
 
             if not all([expression_field, targets]):
                 showWarning("The selected preset is misconfigured. It's missing 'expressionField' or 'targets'.")
+                return None
+
+            note_id_batches = selection.DeckNoteIds(mw.col, deck, expression_field)
+
+            return note_id_batches, expression_field, reading_field, targets, should_replace
+
+        def _on_run(self):
+            args = self._get_backfill_args()
+            if not args:
                 return
-            
+
             self.accept() # Close dialog before starting the long operation
+
+            shared.run_backfill_operation(mw, *args)
+
+        def _on_prefetch(self):
+            args = self._get_backfill_args()
+            if not args:
+                return
+
+            self.accept()
+
+            shared.run_prefetch_operation(mw, *args)
+
+def _write_media(col, file):
+    try:
+        content = file.get("content")
+        filename = file.get("ankiFilename")
+        anki_media_dir = col.media.dir()
+        decoded = base64.b64decode(content)
+
+        target_path = os.path.join(anki_media_dir, filename)
+
+        with open(target_path, "wb") as f:
+            f.write(decoded)
+        
+        return True
+    except Exception:
+        return False
+
+def _get_field_from_request(fields, reading, handlebar):
+    if reading:
+        for entry in fields:
+            if entry.get("reading") == reading:
+                return entry.get(handlebar)
+        return None
+    else:
+        return fields[0].get(handlebar)
+
+# https://github.com/wikidattica/reversoanki/pull/1/commits/62f0c9145a5ef7b2bde1dc6dfd5f23a53daac4d0
+def backfill_notes(col, note_id_batches, expression_field, reading_field, field, handlebar, should_replace):
+    """The manual backfill of a single field, run by the dialog's CollectionOp. note_id_batches are the batches of note ids to fill, e.g. selection.DeckNoteIds."""
+    notes = []
+    # notes sharing a lookup are answered from the cache, but nothing older than the run is reused
+    cached_since = time.time()
+    for nid in itertools.chain.from_iterable(note_id_batches):
+        note = col.get_note(nid)
+        if not expression_field in note or not field in note:
+            continue
+
+        current = note[field].strip()
+        if should_replace or not current:
+            reading = note[reading_field] if reading_field else None
+            api_request = yomitan_api.request_handlebar(note[expression_field].strip(), reading, handlebar, cached_since)
+            if not api_request:
+                continue
+
+            fields = api_request.get("fields")
+            if not fields:
+                continue
+
+            data = _get_field_from_request(fields, reading, handlebar)
+            if not data:
+                continue
+
+            # checks if handlebar data contains filename and writes it to anki if present
+            dictionary_media = api_request.get("dictionaryMedia", [])
+            for file in dictionary_media:
+                filename = file.get("ankiFilename")
+                if filename in data:
+                    _write_media(col, file)
             
-            note_ids = mw.col.db.list("SELECT DISTINCT nid FROM cards WHERE did = ?", deck)
-            
-            shared.run_backfill_operation(mw, note_ids, expression_field, reading_field, targets, should_replace)
\ No newline at end of file
+            audio_media = api_request.get("audioMedia", [])
+            for file in audio_media:
+                filename = file.get("ankiFilename")
+                # if audio handlebar is requested, handlebar data contains the relevant audio filename, write only that file
+                if filename in data:
+                    _write_media(col, file)
+                    break
+
+            note[field] = data
+            notes.append(note)
+
+    return OpChangesWithCount(changes=col.update_notes(notes), count=len(notes))
+
+tools_backfill = ToolsBackfill()
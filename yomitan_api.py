@@ -1,51 +1,161 @@
+import abc
 import json
-import urllib
+import os
+import threading
+import time
+import urllib.request
 from urllib.error import HTTPError, URLError
+from . import cache
 
 request_url = "http://127.0.0.1:8766"
 request_timeout = 10
 ping_timeout = 5
+# a successful ping is reused for this many seconds
+ping_max_age = 60
 
-# https://github.com/Kuuuube/yomitan-api/blob/master/docs/api_paths/ankiFields.md
-def request_handlebar(expression, reading, handlebar):
+# set by shared, the cache is only opened on the first request
+cache_path = None
+cache_max_size = 512 * 1024 * 1024
+# A 500 usually means the handlebar doesn't exist for the term, but it can also be a
+# transient Yomitan error, so lookups without a result are only cached for a day
+negative_cache_seconds = 24 * 60 * 60
+
+_lookup_cache = None
+_lookup_cache_lock = threading.Lock()
+_last_ping = None
+
+class Backend(abc.ABC):
+    """
+    Answers /ankiFields lookups.
+    request returns a response shaped like Yomitan's (fields, dictionaryMedia, audioMedia),
+    or None if there is no result for the text.
+    """
+    # whether responses should go through the lookup cache
+    cacheable = True
+    # shown when ping fails
+    unreachable_message = "Could not reach the lookup backend."
+
+    def version(self):
+        """Returns a string identifying what the backend answers with, cached lookups of other versions aren't used."""
+        return ""
+
+    @abc.abstractmethod
+    def request(self, text, markers, max_entries):
+        pass
+
+    @abc.abstractmethod
+    def ping(self):
+        """Returns something truthy describing the backend if it can answer requests, otherwise False."""
+        pass
+
+class YomitanApiBackend(Backend):
+    """Sends the lookups to the Yomitan API running in the browser."""
+    unreachable_message = "Could not connect to the Yomitan server. Please ensure it's running."
+
+    def __init__(self):
+        # /yomitanVersion response of the last successful ping
+        self._version = None
+
+    def version(self):
+        return json.dumps(self._version, sort_keys=True) if self._version else ""
+
+    # https://github.com/Kuuuube/yomitan-api/blob/master/docs/api_paths/ankiFields.md
+    def request(self, text, markers, max_entries):
+        body = {
+            "text": text,
+            "type": "term",
+            "markers": markers,
+            "maxEntries": max_entries,
+            "includeMedia": True
+        }
+
+        req = urllib.request.Request(
+            request_url + "/ankiFields",
+            data=json.dumps(body).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+
+        try:
+            response = urllib.request.urlopen(req, timeout=request_timeout)
+            return json.loads(response.read())
+        except HTTPError as e:
+            if e.code == 500:
+                # this throws if the handlebar does not exist for specified term
+                return None
+            else:
+                raise
+        except URLError as e:
+            raise ConnectionRefusedError(f"Request to Yomitan API failed: {e.reason}")
+
+    def ping(self):
+        req = urllib.request.Request(request_url + "/yomitanVersion", method="POST")
+        try:
+            response = urllib.request.urlopen(req, timeout=ping_timeout)
+            self._version = json.loads(response.read())
+            return self._version
+        except Exception:
+            return False
+
+# replaced by shared if another backend is configured
+backend = YomitanApiBackend()
+
+def get_lookup_cache():
+    """Opens the lookup cache on first use, on disk if cache_path is set."""
+    global _lookup_cache
+    with _lookup_cache_lock:
+        if _lookup_cache is None:
+            if cache_path:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            _lookup_cache = cache.LookupCache(cache_path, max_size=cache_max_size)
+        return _lookup_cache
+
+def _get_markers(handlebar):
     if isinstance(handlebar, list):
-        markers = handlebar + ["reading"]
-    else:
-        markers = [handlebar, "reading"]
-    body = {
-        "text": expression,
-        "type": "term",
-        "markers": markers,
-        "maxEntries": 4 if reading else 1, # should probably be configurable
-        "includeMedia": True
-    }
-
-    req = urllib.request.Request(
-        request_url + "/ankiFields",
-        data=json.dumps(body).encode("utf-8"),
-        headers={"Content-Type": "application/json"},
-        method="POST",
-    )
-
-    try:
-        response = urllib.request.urlopen(req, timeout=request_timeout)  
-        data = json.loads(response.read())
-    except HTTPError as e:
-        if e.code == 500:
-            # this throws if the handlebar does not exist for specified term
-            return None
+        return handlebar + ["reading"]
+    return [handlebar, "reading"]
+
+def _get_max_entries(reading):
+    return 4 if reading else 1 # should probably be configurable
+
+def get_request_key(expression, reading, handlebar):
+    """Returns the cache key of the request request_handlebar sends for these arguments."""
+    return cache.make_key(expression, _get_max_entries(reading), _get_markers(handlebar), backend.version())
+
+def request_handlebar(expression, reading, handlebar, cached_since):
+    """
+    Returns the backend's response for the lookup, or None if it has no result.
+    Only lookups cached at or after cached_since (a time.time()) are reused, usually the start of
+    the run or of its prefetch, so changed dictionaries or audio sources are picked up by the next run.
+    """
+    markers = _get_markers(handlebar)
+    max_entries = _get_max_entries(reading)
+
+    use_cache = backend.cacheable
+    key = get_request_key(expression, reading, handlebar)
+    if use_cache:
+        cached = get_lookup_cache().get(key, since=cached_since)
+        if cached is not None:
+            return cached or None
+
+    data = backend.request(expression, markers, max_entries)
+
+    if use_cache:
+        if data:
+            get_lookup_cache().put(key, data)
         else:
-            raise
-    except URLError as e:
-        raise ConnectionRefusedError(f"Request to Yomitan API failed: {e.reason}")
-    
+            get_lookup_cache().put(key, {}, ttl=negative_cache_seconds)
+    return data
+
+def ping_yomitan():
+    global _last_ping
+    data = backend.ping()
+    _last_ping = (time.monotonic(), data) if data else None
     return data
 
-def ping_yomitan(): 
-    req = urllib.request.Request(request_url + "/yomitanVersion", method="POST")
-    try:
-        response = urllib.request.urlopen(req, timeout=ping_timeout)  
-        data = json.loads(response.read())
-        return data
-    except Exception:
-        return False
\ No newline at end of file
+def cached_ping():
+    """Returns the result of the last ping if it succeeded within ping_max_age seconds, otherwise None."""
+    last_ping = _last_ping
+    if last_ping and time.monotonic() - last_ping[0] < ping_max_age:
+        return last_ping[1]
+    return None